@@ -33,130 +33,472 @@ def user_subscription(db_user: object, request: Request, db: DBDep, user_agent:
     pass
 
 ### MARZBAN SUBSCRIPTIONS ###
-@router.get("/{token}/")
-@router.get("/{token}", include_in_schema=False)
-async def upsert_user(
+import re as _marzban_re
+from base64 import b64decode as _marzban_b64decode, b64encode as _marzban_b64encode
+from collections import OrderedDict as _MarzbanOrderedDict
+from datetime import datetime as _MarzbanDatetime
+from hashlib import md5 as _marzban_md5, sha256 as _marzban_sha256
+from inspect import (
+    isawaitable as _marzban_isawaitable,
+    iscoroutinefunction as _marzban_iscoroutinefunction,
+)
+from json import loads as _marzban_json_loads
+from os import stat as _marzban_stat
+from time import monotonic as _marzban_monotonic
+from typing import List as _MarzbanList, Tuple as _MarzbanTuple, Union as _MarzbanUnion
+
+import jwt as _marzban_jwt  # noqa
+from fastapi import HTTPException as _MarzbanHTTPException, Response as _MarzbanResponse  # noqa
+from pydantic import BaseModel as _MarzbanBaseModel  # noqa
+from sqlalchemy import text as _marzban_text  # noqa
+from sqlalchemy.exc import (  # noqa
+    OperationalError as _MarzbanOperationalError,
+    ProgrammingError as _MarzbanProgrammingError,
+)
+
+MARZBAN_JWT_TOKENS: _MarzbanList[str] = {{ marzban_jwt_tokens }}  # noqa
+# the updater writes the tokens of the newly imported panels here, they are loaded without a restart
+MARZBAN_JWT_TOKENS_FILE_PATH = "/var/lib/marzneshin/marzban_jwt_tokens.txt"
+MARZBAN_JWT_TOKENS_CHECK_INTERVAL = 1  # seconds between the checks of the tokens file
+MARZBAN_JWT_TOKEN_PREFIX = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9."
+MARZBAN_USERNAME_PATTERN = _marzban_re.compile(r"\W")
+
+
+def marzban_make_panels(marzban_jwt_tokens: _MarzbanList[str]) -> _MarzbanList[_MarzbanTuple[str, str]]:
+    '''
+    Pair the jwt tokens with their panels, the importer keys the imported usernames by the same hash
+    '''
+    return [
+        (marzban_jwt_token, _marzban_sha256(marzban_jwt_token.encode()).hexdigest()[:16])
+        for marzban_jwt_token in marzban_jwt_tokens
+    ]
+
+
+MARZBAN_PANELS: _MarzbanList[_MarzbanTuple[str, str]] = marzban_make_panels(MARZBAN_JWT_TOKENS)
+# the panels of the tokens file, the file is checked once in MARZBAN_JWT_TOKENS_CHECK_INTERVAL
+marzban_panels = MARZBAN_PANELS
+marzban_jwt_tokens_file_version = None
+marzban_jwt_tokens_checked_at = 0.0
+
+MARZBAN_USERS_QUERY = _marzban_text(
+    "SELECT users.username FROM marzban_users"
+    " JOIN users ON users.id = marzban_users.user_id"
+    " WHERE marzban_users.panel = :panel AND marzban_users.username = :username"
+)
+MARZBAN_USER_PANELS_QUERY = _marzban_text(
+    "SELECT marzban_users.username, marzban_users.panel, users.username FROM marzban_users"
+    " JOIN users ON users.id = marzban_users.user_id"
+)
+marzban_users_table_exists = True
+
+# the (panel, marzneshin username) pairs of the imported usernames, a token is verified only by
+# the secrets of its user panels and its user is found without querying marzban_users again
+marzban_user_panels: dict = {}
+marzban_user_panels_loaded = False
+
+# verified tokens, so the repeated requests of a client skip the signature checks
+MARZBAN_TOKENS_CACHE_SIZE = 50000
+MARZBAN_TOKENS_CACHE_TTL = 3600  # seconds
+marzban_tokens_cache: _MarzbanOrderedDict = _MarzbanOrderedDict()
+
+# generated subscriptions, so the clients that poll an unchanged user skip the generation
+MARZBAN_RESPONSES_CACHE_SIZE = 64 * 1024 * 1024  # bytes of the cached bodies
+MARZBAN_RESPONSES_CACHE_TTL = 300  # seconds, the hosts and settings are not in the user version
+# the subscription-userinfo header has the traffic and limits, so they are in the user version too
+MARZBAN_USER_VERSION_FIELDS = (
+    "edit_at",
+    "sub_revoked_at",
+    "key",
+    "enabled",
+    "activated",
+    "expired",
+    "data_limit_reached",
+    "used_traffic",
+    "lifetime_used_traffic",
+    "data_limit",
+    "expire_date",
+)
+marzban_responses_cache: _MarzbanOrderedDict = _MarzbanOrderedDict()
+marzban_responses_cache_size = 0
+
+
+def marzban_get_panels() -> _MarzbanList[_MarzbanTuple[str, str]]:
+    '''
+    Get the marzban panels, reloading them when the updater replaces the tokens file
+    '''
+    global marzban_panels, marzban_jwt_tokens_file_version, marzban_jwt_tokens_checked_at
+    global marzban_user_panels_loaded
+    now = _marzban_monotonic()
+    if now - marzban_jwt_tokens_checked_at < MARZBAN_JWT_TOKENS_CHECK_INTERVAL:
+        return marzban_panels
+    marzban_jwt_tokens_checked_at = now
+
+    try:
+        tokens_file_stat = _marzban_stat(MARZBAN_JWT_TOKENS_FILE_PATH)
+        # the file is replaced by a rename, so a new file has a new inode
+        version = (tokens_file_stat.st_ino, tokens_file_stat.st_mtime_ns)
+        if version == marzban_jwt_tokens_file_version:
+            return marzban_panels
+        with open(MARZBAN_JWT_TOKENS_FILE_PATH) as f:
+            tokens = [token.strip() for token in f.read().splitlines() if token.strip()]
+    except OSError:
+        # the tokens of the source are used until the updater writes the file
+        return marzban_panels
+
+    marzban_jwt_tokens_file_version = version
+    if tokens:
+        marzban_panels = marzban_make_panels(tokens)
+        # the tokens of a removed panel must not be accepted from the cache
+        marzban_tokens_cache.clear()
+        # the users of a new panel are imported with its token
+        marzban_user_panels_loaded = False
+    return marzban_panels
+
+
+def marzban_get_user_panels(username: _MarzbanUnion[str, None]) -> _MarzbanList[_MarzbanTuple[str, str]]:
+    '''
+    Get the panels in the order their secrets are tried, the imported panels of the username first
+    '''
+    panels = marzban_get_panels()
+    if not username:
+        return panels
+    user_panels = marzban_user_panels.get(MARZBAN_USERNAME_PATTERN.sub("", username.lower()))
+    if not user_panels:
+        return panels
+    # the same username may be in other panels that its users are not imported by or
+    # are imported before marzban_users, they are scanned if the imported panels do not verify it
+    user_panel_ids = {user_panel for user_panel, _ in user_panels}
+    return [panel for panel in panels if panel[1] in user_panel_ids] + [
+        panel for panel in panels if panel[1] not in user_panel_ids
+    ]
+
+
+def marzban_jwt_username(token: str) -> _MarzbanUnion[str, None]:
+    '''
+    Read the username of a jwt token before verifying it, to find the secrets it may be signed by
+    '''
+    try:
+        payload = token.split(".")[1]
+        username = _marzban_json_loads(
+            _marzban_b64decode(payload + "=" * (-len(payload) % 4), altchars=b"-_")
+        ).get("sub")
+    except Exception:  # noqa
+        return None
+    return username if isinstance(username, str) else None
+
+
+class MarzbanToken(_MarzbanBaseModel):
+    panel: str
+    username: str
+    created_at: _MarzbanDatetime | str
+
+
+def marzban_get_subscription_payload(
         token: str,
-        request: Request,
-        db: DBDep,
-        user_agent: str = Header(default=""),
-):
-    import re
-
-    from base64 import b64decode, b64encode
-    from datetime import datetime
-    from hashlib import sha256, md5
-    from typing import Union, List
-    from inspect import iscoroutinefunction
-
-    from pydantic import BaseModel # noqa
-    import jwt # noqa
-    from fastapi import HTTPException, Response # noqa
-    from fastapi.responses import HTMLResponse # noqa
-
-    class MarzbanToken(BaseModel):
-        username: str
-        created_at: datetime | str
-
-    marzban_jwt_tokens: List[str] = {{ marzban_jwt_tokens }}  # noqa
-
-    def get_subscription_payload(
-            token: str, # noqa
-    ) -> Union[MarzbanToken, None]:
-        try:
-            if len(token) < 15:
-                return None
+) -> _MarzbanUnion[MarzbanToken, None]:
+    '''
+    Verify the marzban subscription token
+    '''
+    try:
+        if len(token) < 15:
+            return None
 
-            if token.startswith("eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9."):
-                for marzban_jwt_token in marzban_jwt_tokens:
-                    try:
-                        payload = jwt.decode(token, marzban_jwt_token, algorithms=["HS256"])
-                    except jwt.InvalidSignatureError:
-                        continue
-
-                    if payload.get("access") == "subscription":
-                        return MarzbanToken(
-                            username=payload["sub"],
-                            created_at=datetime.utcfromtimestamp(payload["iat"]),  # noqa
-                        )
-                    else:
-                        return None
-            else:
-                u_token, u_signature = token[:-10], token[-10:]
+        if token.startswith(MARZBAN_JWT_TOKEN_PREFIX):
+            for marzban_jwt_token, marzban_panel in marzban_get_user_panels(marzban_jwt_username(token)):
                 try:
-                    u_token_dec = b64decode(
-                        u_token.encode("utf-8")
-                        + b"=" * (-len(u_token.encode("utf-8")) % 4),
-                        altchars=b"-_",
-                        validate=True,
-                    ).decode("utf-8")
-                except Exception as e:
-                    print(e)
-                    return None
+                    payload = _marzban_jwt.decode(token, marzban_jwt_token, algorithms=["HS256"])
+                except _marzban_jwt.InvalidSignatureError:
+                    continue
 
-                for marzban_jwt_token in marzban_jwt_tokens:
-                    u_token_resign = b64encode(
-                        sha256((u_token + marzban_jwt_token).encode("utf-8")).digest(),
-                        altchars=b"-_",
-                    ).decode("utf-8")[:10]
-
-                    if u_signature == u_token_resign:
-                        u_username, u_created_at = u_token_dec.split(",")
-                        return MarzbanToken(
-                            username=u_username,
-                            created_at=datetime.utcfromtimestamp(int(u_created_at)),  # noqa
-                        )
+                if payload.get("access") == "subscription":
+                    return MarzbanToken(
+                        panel=marzban_panel,
+                        username=payload["sub"],
+                        created_at=_MarzbanDatetime.utcfromtimestamp(payload["iat"]),  # noqa
+                    )
+                else:
+                    return None
+        else:
+            u_token, u_signature = token[:-10], token[-10:]
+            try:
+                u_token_dec = _marzban_b64decode(
+                    u_token.encode("utf-8")
+                    + b"=" * (-len(u_token.encode("utf-8")) % 4),
+                    altchars=b"-_",
+                    validate=True,
+                ).decode("utf-8")
+            except Exception as e:
+                print(e)
                 return None
-        except jwt.PyJWTError:
+
+            for marzban_jwt_token, marzban_panel in marzban_get_user_panels(u_token_dec.split(",")[0]):
+                u_token_resign = _marzban_b64encode(
+                    _marzban_sha256((u_token + marzban_jwt_token).encode("utf-8")).digest(),
+                    altchars=b"-_",
+                ).decode("utf-8")[:10]
+
+                if u_signature == u_token_resign:
+                    u_username, u_created_at = u_token_dec.split(",")
+                    return MarzbanToken(
+                        panel=marzban_panel,
+                        username=u_username,
+                        created_at=_MarzbanDatetime.utcfromtimestamp(int(u_created_at)),  # noqa
+                    )
             return None
+    except _marzban_jwt.PyJWTError:
+        return None
+
 
-    sub = get_subscription_payload(token=token)
+def marzban_get_token_user(token: str) -> _MarzbanUnion[_MarzbanTuple[str, str], None]:
+    '''
+    Get the panel and username of the marzban subscription token, verifying it only if it is not cached
+    '''
+    now = _marzban_monotonic()
+    cached = marzban_tokens_cache.get(token)
+    if cached is not None:
+        panel, username, expires_at = cached
+        if expires_at > now:
+            marzban_tokens_cache.move_to_end(token)
+            return panel, username
+        marzban_tokens_cache.pop(token, None)
+
+    sub = marzban_get_subscription_payload(token=token)
     if not sub:
-        raise HTTPException(status_code=400, detail="Invalid subscription token")
+        return None
+
+    username = MARZBAN_USERNAME_PATTERN.sub("", sub.username.lower())
+    marzban_tokens_cache[token] = (sub.panel, username, now + MARZBAN_TOKENS_CACHE_TTL)
+    while len(marzban_tokens_cache) > MARZBAN_TOKENS_CACHE_SIZE:
+        marzban_tokens_cache.popitem(last=False)
+    return sub.panel, username
+
+
+def marzban_is_missing_table(error: Exception) -> bool:
+    '''
+    Check if the error is for the missing marzban_users table, not for a lost connection or a lock
+    '''
+    if not isinstance(error, (_MarzbanOperationalError, _MarzbanProgrammingError)):
+        return False
+    # the message of the driver, the statement in the message of sqlalchemy names the table too
+    message = str(error.orig).lower()
+    return "marzban_users" in message and ("no such table" in message or "exist" in message)
+
 
-    username = re.sub(r"\W", "", sub.username.lower())
+async def marzban_rollback(db) -> None:
+    result = db.rollback()
+    if _marzban_isawaitable(result):
+        await result
 
-    async def get_user(u: str):
-        if iscoroutinefunction(crud.get_user):  # noqa
-            # if marzneshin be completely asynchronous, use `await` to get the result
-            db_user = await crud.get_user(db, u)  # noqa
+
+async def marzban_load_user_panels(db) -> None:
+    '''
+    Load the panels and marzneshin usernames of the imported usernames, once and again when the panels change
+    '''
+    global marzban_user_panels, marzban_user_panels_loaded, marzban_users_table_exists
+    if marzban_user_panels_loaded or not marzban_users_table_exists:
+        return
+    # the requests during the load verify their tokens by all panels
+    marzban_user_panels_loaded = True
+
+    try:
+        result = db.execute(MARZBAN_USER_PANELS_QUERY)
+        if _marzban_isawaitable(result):
+            result = await result
+        user_panels = {}
+        for username, panel, marzneshin_username in result:
+            user_panels[username] = user_panels.get(username, ()) + ((panel, marzneshin_username),)
+    except Exception as e:  # noqa
+        if marzban_is_missing_table(e):
+            # the users are imported before the importer kept their usernames
+            marzban_users_table_exists = False
         else:
-            db_user = crud.get_user(db, u)  # noqa
-        return db_user
-
-    def username_hash(user_username: str) -> str:
-        '''
-        Generate a hash for the username
-        '''
-        return str(int(md5(user_username.encode()).hexdigest(), 16) % 10000).zfill(4)
-
-    async def get_user_with_change_name(
-            user_username: str, exists_checker
-    ):
-        '''
-        Generate a username by appending a hash to the original username
-        '''
-        base_username = user_username
-        if user := await exists_checker(base_username):
+            # the load is retried by the next request
+            marzban_user_panels_loaded = False
+        await marzban_rollback(db)
+        return
+
+    marzban_user_panels = user_panels
+
+
+def marzban_user_version(db_user) -> _MarzbanUnion[tuple, None]:
+    '''
+    Get the version of the user that its subscription depends on, None if it can not be read
+    '''
+    try:
+        return (
+            tuple(getattr(db_user, field, None) for field in MARZBAN_USER_VERSION_FIELDS),
+            tuple(sorted(service.id for service in db_user.services)),
+        )
+    except Exception:  # noqa
+        return None
+
+
+def marzban_get_cached_response(key: tuple, version: tuple):
+    '''
+    Get the cached subscription of the user agent of the user, if the user is not changed since it is generated
+    '''
+    cached = marzban_responses_cache.get(key)
+    if cached is None:
+        return None
+    cached_version, expires_at, status_code, headers, body = cached
+    if cached_version != version or expires_at <= _marzban_monotonic():
+        marzban_pop_cached_response(key)
+        return None
+    marzban_responses_cache.move_to_end(key)
+    return _MarzbanResponse(content=body, status_code=status_code, headers=headers)
+
+
+def marzban_cache_response(key: tuple, version: tuple, response) -> None:
+    '''
+    Cache the generated subscription, evicting the least recently used ones over the cache size
+    '''
+    global marzban_responses_cache_size
+    body = getattr(response, "body", None)
+    # the streamed and failed responses are not cached
+    if not isinstance(response, _MarzbanResponse) or not isinstance(body, bytes):
+        return
+    if response.status_code != 200 or len(body) > MARZBAN_RESPONSES_CACHE_SIZE // 100:
+        return
+
+    marzban_pop_cached_response(key)
+    marzban_responses_cache[key] = (
+        version,
+        _marzban_monotonic() + MARZBAN_RESPONSES_CACHE_TTL,
+        response.status_code,
+        dict(response.headers),
+        body,
+    )
+    marzban_responses_cache_size += len(body)
+    while marzban_responses_cache_size > MARZBAN_RESPONSES_CACHE_SIZE:
+        marzban_pop_cached_response(next(iter(marzban_responses_cache)))
+
+
+def marzban_pop_cached_response(key: tuple) -> None:
+    global marzban_responses_cache_size
+    cached = marzban_responses_cache.pop(key, None)
+    if cached is not None:
+        marzban_responses_cache_size -= len(cached[-1])
+
+
+async def marzban_update_user_sub(db, db_user, user_agent: str) -> None:
+    '''
+    Record the subscription update of a cached subscription, as user_subscription does
+    '''
+    update_user_sub = getattr(crud, "update_user_sub", None)  # noqa
+    if update_user_sub is None:
+        return
+    result = update_user_sub(db, db_user, user_agent)
+    if _marzban_isawaitable(result):
+        await result
+
+
+async def marzban_get_user(db, u: str):
+    if _marzban_iscoroutinefunction(crud.get_user):  # noqa
+        # if marzneshin be completely asynchronous, use `await` to get the result
+        db_user = await crud.get_user(db, u)  # noqa
+    else:
+        db_user = crud.get_user(db, u)  # noqa
+    return db_user
+
+
+async def marzban_get_imported_user(db, panel: str, username: str):
+    '''
+    Find the user by the username that the importer assigned to the marzban user
+    '''
+    global marzban_users_table_exists
+    if not marzban_users_table_exists:
+        return None
+
+    for user_panel, marzneshin_username in marzban_user_panels.get(username, ()):
+        if user_panel == panel and marzneshin_username is not None:
+            if db_user := await marzban_get_user(db, marzneshin_username):
+                return db_user
+            # the user is renamed or deleted since the usernames are loaded
+            break
+
+    try:
+        result = db.execute(MARZBAN_USERS_QUERY, {"panel": panel, "username": username})
+        if _marzban_isawaitable(result):
+            result = await result
+        marzneshin_username = result.scalar()
+    except Exception as e:  # noqa
+        await marzban_rollback(db)
+        if not marzban_is_missing_table(e):
+            # the user is not guessed by its username, it may be another user with the same name
+            raise _MarzbanHTTPException(status_code=503, detail="Try again later")
+        # the users are imported before the importer kept their usernames
+        marzban_users_table_exists = False
+        return None
+
+    if marzneshin_username is None:
+        return None
+    return await marzban_get_user(db, marzneshin_username)
+
+
+def marzban_username_hash(user_username: str) -> str:
+    '''
+    Generate a hash for the username
+    '''
+    return str(int(_marzban_md5(user_username.encode()).hexdigest(), 16) % 10000).zfill(4)
+
+
+async def marzban_get_user_with_change_name(db, user_username: str):
+    '''
+    Find the user by the original username or the username with the appended hashes
+    '''
+    base_username = user_username
+    if user := await marzban_get_user(db, base_username):
+        return user
+    sep = "_"
+    hash_str = marzban_username_hash(base_username)
+    while True:
+        user_username = f"{user_username}{sep}{hash_str}"
+        if len(user_username) >= 32:
+            return None
+        if user := await marzban_get_user(db, user_username):
             return user
-        sep = "_"
-        hash_str = username_hash(base_username)
-        while True:
-            user_username = f"{user_username}{sep}{hash_str}"
-            if len(user_username) >= 32:
-                return None
-            if user := await exists_checker(user_username):
-                return user
-            hash_str = username_hash(user_username)
+        hash_str = marzban_username_hash(user_username)
+
+
+@router.get("/{token}/")
+@router.get("/{token}", include_in_schema=False)
+async def upsert_user(
+        token: str,
+        request: Request,
+        db: DBDep,
+        user_agent: str = Header(default=""),
+):
+    await marzban_load_user_panels(db)
+    token_user = marzban_get_token_user(token)
+    if token_user is None:
+        raise _MarzbanHTTPException(status_code=400, detail="Invalid subscription token")
+    panel, username = token_user
 
-    db_user = await get_user_with_change_name(username, get_user)
+    db_user = await marzban_get_imported_user(db, panel, username)
+    if db_user is None:
+        db_user = await marzban_get_user_with_change_name(db, username)
 
     if db_user is None:
-        raise HTTPException(status_code=400, detail="Invalid subscription token")
+        raise _MarzbanHTTPException(status_code=400, detail="Invalid subscription token")
+
+    # the config format is chosen by the rules on the whole user agent, so it is the class of the client,
+    # the page of the browsers is not cached
+    version = None
+    if "text/html" not in request.headers.get("accept", ""):
+        cache_key = (db_user.id, user_agent)
+        version = marzban_user_version(db_user)
+    if version is not None:
+        response = marzban_get_cached_response(cache_key, version)
+        if response is not None:
+            await marzban_update_user_sub(db, db_user, user_agent)
+            return response
 
-    if iscoroutinefunction(user_subscription):  # noqa
+    if _marzban_iscoroutinefunction(user_subscription):  # noqa
         # if marzneshin be completely asynchronous, use `await` to get the result
-        return await user_subscription(db_user, request, db, user_agent)  # noqa
+        response = await user_subscription(db_user, request, db, user_agent)  # noqa
     else:
-        return user_subscription(db_user, request, db, user_agent)  # noqa
+        response = user_subscription(db_user, request, db, user_agent)  # noqa
 
+    if version is not None:
+        marzban_cache_response(cache_key, version, response)
+    return response
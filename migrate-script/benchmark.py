@@ -0,0 +1,496 @@
+"""
+Benchmark of the migrate script on synthetic marzban datasets
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from hashlib import md5
+from json import dump
+from os import makedirs, remove
+from os.path import exists, getsize, join
+from platform import python_version
+from random import Random
+from resource import getrusage, RUSAGE_CHILDREN, RUSAGE_SELF
+from time import perf_counter
+from types import SimpleNamespace
+from uuid import UUID
+
+import sqlalchemy
+from sqlalchemy import create_engine, event, func, insert, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+import marzban_models as marzban
+import marzneshin_models as marzneshin
+import script_models as script
+from migrate import (
+    export_marzban_data,
+    import_script_data,
+    load_import_checkpoint,
+    create_script_engine,
+    finish_script_db,
+    iter_marzban_data,
+    load_script_archive,
+    marzban_panel_id,
+    migrate_direct,
+    SyncWindow,
+)
+from script_archive import write_script_archive
+
+DEFAULT_ADMINS = 10
+DEFAULT_USERS = 10000
+DEFAULT_USAGES = 24
+DEFAULT_DIRECTORY = "/tmp/marzban2marzneshin-benchmark"
+
+GENERATE_BATCH_SIZE = 10000
+USAGES_START = datetime(2024, 1, 1)
+JWT_SECRET_KEY = "0" * 64
+
+MARZBAN_DB_NAME = "marzban.db"
+SCRIPT_DB_NAME = "marzban2marzneshin.db"
+SCRIPT_ARCHIVE_NAME = "marzban2marzneshin.m2m"
+LOADED_SCRIPT_DB_NAME = "marzban2marzneshin.m2m.db"
+MARZNESHIN_DB_NAME = "marzneshin.db"
+DIRECT_MARZNESHIN_DB_NAME = "marzneshin-direct.db"
+RESULTS_NAME = "benchmark.json"
+
+
+class QueryCounter:
+    """
+    Count the statements executed by every engine of the process
+    """
+
+    def __init__(self) -> None:
+        self.queries = 0
+        event.listen(Engine, "before_cursor_execute", self)
+
+    def __call__(self, *_) -> None:
+        self.queries += 1
+
+    def close(self) -> None:
+        event.remove(Engine, "before_cursor_execute", self)
+
+
+def peak_memory_usage() -> int:
+    """
+    Get the peak resident memory of the process and its finished children in bytes
+    """
+    return max(
+        getrusage(RUSAGE_SELF).ru_maxrss, getrusage(RUSAGE_CHILDREN).ru_maxrss
+    ) * 1024
+
+
+def count_rows(db_path: str, models) -> dict:
+    """
+    Count the rows of the tables of a sqlite database
+    """
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as connection:
+        counts = {
+            table.name: connection.execute(select(func.count()).select_from(table)).scalar()
+            for table in models.Base.metadata.sorted_tables
+            if engine.dialect.has_table(connection, table.name)
+        }
+    engine.dispose()
+    return counts
+
+
+def generate_marzban_database(
+    db_path: str, admins: int, users: int, usages: int, seed: int = 0
+) -> None:
+    """
+    Generate a marzban sqlite database with synthetic admins, users, proxies and usages
+    """
+    random = Random(seed)
+    engine = create_engine(f"sqlite:///{db_path}")
+    marzban.Base.metadata.create_all(engine)
+
+    def batches(rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= GENERATE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def new_uuid() -> str:
+        return str(UUID(int=random.getrandbits(128), version=4))
+
+    with engine.begin() as connection:
+        connection.execute(
+            insert(marzban.Admin),
+            [
+                dict(
+                    id=admin_id,
+                    username=f"admin{admin_id}",
+                    hashed_password=md5(str(admin_id).encode()).hexdigest(),
+                    is_sudo=admin_id == 1,
+                    created_at=USAGES_START,
+                )
+                for admin_id in range(1, admins + 1)
+            ],
+        )
+
+        statuses = list(marzban.UserStatus)
+        for batch in batches(
+            dict(
+                id=user_id,
+                username=f"user{user_id}",
+                status=(status := random.choice(statuses)),
+                used_traffic=random.randint(0, 10 ** 11),
+                data_limit=random.choice((None, 10 ** 11)),
+                data_limit_reset_strategy=marzban.UserDataLimitResetStrategy.no_reset,
+                expire=random.choice((None, 1700000000, 1900000000)),
+                admin_id=random.randint(1, admins),
+                created_at=USAGES_START,
+                edit_at=USAGES_START,
+                on_hold_expire_duration=86400 if status == marzban.UserStatus.on_hold else None,
+            )
+            for user_id in range(1, users + 1)
+        ):
+            connection.execute(insert(marzban.User), batch)
+
+        # most users have vless and vmess, some only one of them or only trojan
+        protocols = (
+            ("vless", "vmess"),
+            ("vless", "vmess", "trojan"),
+            ("vless",),
+            ("vmess",),
+            ("trojan",),
+        )
+        for batch in batches(
+            dict(
+                user_id=user_id,
+                type=marzban.ProxyTypes(protocol),
+                settings={"password": new_uuid()} if protocol == "trojan" else {"id": new_uuid()},
+            )
+            for user_id in range(1, users + 1)
+            for protocol in random.choices(protocols, (6, 2, 1, 1, 1))[0]
+        ):
+            connection.execute(insert(marzban.Proxy), batch)
+
+        for batch in batches(
+            dict(
+                user_id=user_id,
+                used_traffic_at_reset=random.randint(0, 10 ** 10),
+                reset_at=USAGES_START,
+            )
+            for user_id in range(1, users + 1)
+            if random.random() < 0.2
+        ):
+            connection.execute(insert(marzban.UserUsageResetLogs), batch)
+
+        for batch in batches(
+            dict(
+                user_id=user_id,
+                node_id=None,
+                created_at=USAGES_START + timedelta(hours=hour),
+                used_traffic=random.randint(0, 10 ** 9),
+            )
+            for user_id in range(1, users + 1)
+            for hour in range(usages)
+        ):
+            connection.execute(insert(marzban.NodeUserUsage), batch)
+
+        connection.execute(
+            insert(marzban.NodeUsage),
+            [
+                dict(
+                    node_id=None,
+                    created_at=USAGES_START + timedelta(hours=hour),
+                    uplink=random.randint(0, 10 ** 12),
+                    downlink=random.randint(0, 10 ** 12),
+                )
+                for hour in range(usages)
+            ],
+        )
+        connection.execute(insert(marzban.System), [dict(uplink=10 ** 12, downlink=10 ** 13)])
+        connection.execute(insert(marzban.JWT), [dict(secret_key=JWT_SECRET_KEY)])
+    engine.dispose()
+
+
+def create_marzneshin_database(db_path: str) -> None:
+    """
+    Create an empty marzneshin sqlite database with a node and its inbounds
+    """
+    engine = create_engine(f"sqlite:///{db_path}")
+
+    # sqlite does not accept the empty server default of the admins subscription url prefix
+    column = marzneshin.Admin.__table__.c.subscription_url_prefix
+    server_default, column.server_default = column.server_default, None
+    try:
+        marzneshin.Base.metadata.create_all(engine)
+    finally:
+        column.server_default = server_default
+
+    with engine.begin() as connection:
+        connection.execute(
+            insert(marzneshin.Node),
+            [dict(id=1, name="node", address="127.0.0.1", port=62050)],
+        )
+        connection.execute(
+            insert(marzneshin.Inbound),
+            [
+                dict(id=1, protocol=marzneshin.ProxyTypes.VLESS, tag="vless", config="{}", node_id=1),
+                dict(id=2, protocol=marzneshin.ProxyTypes.VMess, tag="vmess", config="{}", node_id=1),
+            ],
+        )
+        connection.execute(insert(marzneshin.System), [dict(id=1, uplink=0, downlink=0)])
+    engine.dispose()
+
+
+def run_export(marzban_db_path: str, script_db_path: str, workers: int) -> dict:
+    """
+    Export the marzban database to the script database, as marzban_exporter does
+    """
+    counter = QueryCounter()
+    started_at = perf_counter()
+
+    ms = Session(create_engine(f"sqlite:///{marzban_db_path}"), autoflush=False)
+    script_engine = create_script_engine(script_db_path, True)
+    ss = Session(bind=script_engine)
+    script.Base.metadata.drop_all(script_engine)
+    script.Base.metadata.create_all(script_engine)
+
+    export_marzban_data(
+        ms,
+        ss,
+        "vless",
+        "revoke",
+        "",
+        SimpleNamespace(completed=0),
+        workers,
+    )
+    ms.close()
+    ss.close()
+    finish_script_db(script_engine)
+    counter.close()
+
+    return dict(
+        seconds=perf_counter() - started_at,
+        queries=counter.queries,
+        peak_memory=peak_memory_usage(),
+    )
+
+
+def run_export_archive(marzban_db_path: str, script_archive_path: str) -> dict:
+    """
+    Export the marzban database to the compressed datastore, as marzban_exporter does
+    """
+    counter = QueryCounter()
+    started_at = perf_counter()
+
+    ms = Session(create_engine(f"sqlite:///{marzban_db_path}"), autoflush=False)
+    write_script_archive(
+        script_archive_path,
+        iter_marzban_data(ms, "vless", "revoke", "", SimpleNamespace(completed=0)),
+    )
+    ms.close()
+    counter.close()
+
+    return dict(
+        seconds=perf_counter() - started_at,
+        queries=counter.queries,
+        peak_memory=peak_memory_usage(),
+    )
+
+
+def run_load_archive(script_archive_path: str, script_db_path: str) -> dict:
+    """
+    Load the compressed datastore to a sqlite datastore, as the importer does
+    """
+    counter = QueryCounter()
+    started_at = perf_counter()
+
+    load_script_archive(script_archive_path, script_db_path)
+    counter.close()
+
+    return dict(
+        seconds=perf_counter() - started_at,
+        queries=counter.queries,
+        peak_memory=peak_memory_usage(),
+    )
+
+
+def run_import(script_db_path: str, marzneshin_db_path: str) -> dict:
+    """
+    Import the script database to the marzneshin database, as marzneshin_importer does for a new marzneshin
+    """
+    counter = QueryCounter()
+    started_at = perf_counter()
+
+    db_uri = f"sqlite:///{marzneshin_db_path}"
+    ms = Session(create_engine(db_uri), autoflush=False)
+    ss = Session(create_engine(f"sqlite:///{script_db_path}"))
+
+    checkpoint = load_import_checkpoint(ms, ss, md5(db_uri.encode()).hexdigest())
+    import_script_data(
+        ms,
+        ss,
+        ms.query(marzneshin.Node.id).scalar(),
+        ms.query(marzneshin.Inbound).all(),
+        "skip",
+        "skip",
+        SimpleNamespace(completed=0),
+        checkpoint,
+        SyncWindow(
+            ms, ss, marzban_panel_id(ss.query(script.JWT.secret_key).scalar()), checkpoint.incremental
+        ),
+    )
+    ms.close()
+    ss.close()
+    counter.close()
+
+    return dict(
+        seconds=perf_counter() - started_at,
+        queries=counter.queries,
+        peak_memory=peak_memory_usage(),
+    )
+
+
+def run_direct(marzban_db_path: str, marzneshin_db_path: str) -> dict:
+    """
+    Migrate the marzban database straight to the marzneshin database, as direct_migrator does for a new marzneshin
+    """
+    counter = QueryCounter()
+    started_at = perf_counter()
+
+    migrate_direct(
+        f"sqlite:///{marzban_db_path}",
+        "",
+        "vless",
+        "revoke",
+        f"sqlite:///{marzneshin_db_path}",
+        "skip",
+        "skip",
+        save_jwt_token=False,
+    )
+    counter.close()
+
+    return dict(
+        seconds=perf_counter() - started_at,
+        queries=counter.queries,
+        peak_memory=peak_memory_usage(),
+    )
+
+
+def run_phase(function, *args) -> dict:
+    """
+    Run a phase in a new process, so its queries and peak memory are measured alone
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args).result()
+
+
+def benchmark(
+    directory: str, admins: int, users: int, usages: int, workers: int, seed: int
+) -> dict:
+    """
+    Generate a dataset, export and import it, migrate it directly and return the measurements of each phase
+    """
+    makedirs(directory, exist_ok=True)
+    marzban_db_path = join(directory, MARZBAN_DB_NAME)
+    script_db_path = join(directory, SCRIPT_DB_NAME)
+    script_archive_path = join(directory, SCRIPT_ARCHIVE_NAME)
+    loaded_script_db_path = join(directory, LOADED_SCRIPT_DB_NAME)
+    marzneshin_db_path = join(directory, MARZNESHIN_DB_NAME)
+    direct_marzneshin_db_path = join(directory, DIRECT_MARZNESHIN_DB_NAME)
+    for db_path in (
+        marzban_db_path,
+        script_db_path,
+        script_archive_path,
+        loaded_script_db_path,
+        marzneshin_db_path,
+        direct_marzneshin_db_path,
+    ):
+        if exists(db_path):
+            remove(db_path)
+
+    started_at = perf_counter()
+    generate_marzban_database(marzban_db_path, admins, users, usages, seed)
+    create_marzneshin_database(marzneshin_db_path)
+    create_marzneshin_database(direct_marzneshin_db_path)
+    phases = dict(generate=dict(seconds=perf_counter() - started_at))
+
+    phases["export"] = run_phase(run_export, marzban_db_path, script_db_path, workers)
+    phases["export"]["rows"] = sum(count_rows(script_db_path, script).values())
+    phases["export"]["bytes"] = getsize(script_db_path)
+
+    phases["compressed export"] = run_phase(run_export_archive, marzban_db_path, script_archive_path)
+    phases["compressed export"]["rows"] = phases["export"]["rows"]
+    phases["compressed export"]["bytes"] = getsize(script_archive_path)
+
+    phases["compressed load"] = run_phase(run_load_archive, script_archive_path, loaded_script_db_path)
+    phases["compressed load"]["rows"] = sum(count_rows(loaded_script_db_path, script).values())
+
+    rows_before = count_rows(marzneshin_db_path, marzneshin)
+    phases["import"] = run_phase(run_import, script_db_path, marzneshin_db_path)
+    rows_after = count_rows(marzneshin_db_path, marzneshin)
+    phases["import"]["rows"] = sum(rows_after.values()) - sum(rows_before.values())
+
+    phases["direct"] = run_phase(run_direct, marzban_db_path, direct_marzneshin_db_path)
+    rows_after = count_rows(direct_marzneshin_db_path, marzneshin)
+    phases["direct"]["rows"] = sum(rows_after.values()) - sum(rows_before.values())
+
+    for measurements in phases.values():
+        if "rows" in measurements:
+            measurements["rows_per_second"] = measurements["rows"] / measurements["seconds"]
+
+    return dict(
+        created_at=datetime.now().isoformat(timespec="seconds"),
+        python=python_version(),
+        sqlalchemy=sqlalchemy.__version__,
+        dataset=dict(
+            admins=admins,
+            users=users,
+            usages_per_user=usages,
+            workers=workers,
+            seed=seed,
+            marzban=count_rows(marzban_db_path, marzban),
+        ),
+        phases=phases,
+    )
+
+
+def main() -> None:
+    parser = ArgumentParser(description="Benchmark the export and import on a synthetic marzban database")
+    parser.add_argument("--admins", type=int, default=DEFAULT_ADMINS)
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS)
+    parser.add_argument("--usages", type=int, default=DEFAULT_USAGES, help="hourly usages of each user")
+    parser.add_argument("--workers", type=int, default=1, help="processes that export the users")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--directory", default=DEFAULT_DIRECTORY, help="where the databases are created")
+    parser.add_argument("--output", help="path of the json results (default: benchmark.json in the directory)")
+    arguments = parser.parse_args()
+
+    results = benchmark(
+        arguments.directory,
+        arguments.admins,
+        arguments.users,
+        arguments.usages,
+        arguments.workers,
+        arguments.seed,
+    )
+    output = arguments.output or join(arguments.directory, RESULTS_NAME)
+    with open(output, "w") as file:
+        dump(results, file, indent=2)
+
+    for name, measurements in results["phases"].items():
+        line = f"{name}: {measurements['seconds']:.2f}s"
+        if "rows" in measurements:
+            line += (
+                f", {measurements['rows']} rows, {measurements['rows_per_second']:.0f} rows/s"
+                f", {measurements['queries']} queries"
+                f", {measurements['peak_memory'] / 1024 / 1024:.1f} MiB peak memory"
+            )
+        if "bytes" in measurements:
+            line += f", {measurements['bytes'] / 1024 / 1024:.1f} MiB file"
+        print(line)
+    print(f"The results are saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -380,4 +380,51 @@ class NodeUsage(Base):
     node_id = Column(Integer, ForeignKey("nodes.id"))
     node = relationship("Node", back_populates="usages")
     uplink = Column(BigInteger, default=0)
-    downlink = Column(BigInteger, default=0)
\ No newline at end of file
+    downlink = Column(BigInteger, default=0)
+
+class MarzbanUser(Base):
+    # not a marzneshin table, the importer keeps the imported marzban usernames
+    # in it so the marzban subscription route finds the users without guessing
+    __tablename__ = "marzban_users"
+
+    panel = Column(String(16), primary_key=True)  # hash of the marzban jwt secret key
+    username = Column(String(64), primary_key=True)
+    user_id = Column(Integer, nullable=False)
+
+
+class MarzbanAdmin(Base):
+    # not a marzneshin table, the imported marzban admins so the next imports
+    # of the same panel find them even if they are renamed
+    __tablename__ = "marzban_admins"
+
+    panel = Column(String(16), primary_key=True)  # hash of the marzban jwt secret key
+    username = Column(String(64), primary_key=True)
+    admin_id = Column(Integer, nullable=False)
+
+
+class MarzbanSync(Base):
+    # not a marzneshin table, the high-water marks of the last import of every
+    # marzban panel, an incremental import moves only the data after them
+    __tablename__ = "marzban_syncs"
+
+    panel = Column(String(16), primary_key=True)  # hash of the marzban jwt secret key
+    exported_at = Column(DateTime, nullable=False)  # the users changed after it are imported again
+    user_id = Column(Integer, nullable=False, default=0)  # the last imported marzban user
+    usages_since = Column(DateTime, nullable=False)  # the usages before it are complete
+    uplink = Column(BigInteger, nullable=False, default=0)  # the imported system traffic
+    downlink = Column(BigInteger, nullable=False, default=0)
+    imports = Column(Integer, nullable=False, default=0)  # shows whether the last import is committed
+
+
+class MarzbanSyncUsage(Base):
+    # not a marzneshin table, the usages of the hours that were not complete in
+    # the last import of a panel, the next import adds only what is added to them
+    __tablename__ = "marzban_sync_usages"
+
+    panel = Column(String(16), primary_key=True)
+    user_id = Column(Integer, primary_key=True)  # marzneshin user id, 0 for the node usages
+    created_at = Column(DateTime, primary_key=True)
+    node_id = Column(Integer, nullable=False)
+    used_traffic = Column(BigInteger, nullable=False, default=0)
+    uplink = Column(BigInteger, nullable=False, default=0)
+    downlink = Column(BigInteger, nullable=False, default=0)
@@ -2,28 +2,61 @@
 Migrate script for migrating from marzban to marzneshin
 """
 
+from argparse import ArgumentParser, Namespace
+from asyncio import create_task, Queue as AsyncQueue, run as run_async
+from collections import defaultdict
+from concurrent.futures import as_completed, ProcessPoolExecutor
 from contextlib import contextmanager
-from datetime import datetime, timezone as datetime_timezone
-from hashlib import md5
+from datetime import datetime, timedelta, timezone as datetime_timezone
+from hashlib import md5, sha256
+from heapq import heappush, heappushpop
+from importlib.util import find_spec
 from inspect import isfunction
-from os import mkdir, system as os_system
-from os.path import exists
+from itertools import chain
+from json import dump
+from os import cpu_count, mkdir, remove, replace, system as os_system
+from os.path import exists, getmtime
+from queue import Full, Queue
 from random import choices
-from re import sub
+from secrets import token_hex
+from re import compile as re_compile, IGNORECASE, sub
+from resource import getrusage, RUSAGE_SELF
 from sqlite3 import connect, Error
 from string import ascii_letters, digits
-from sys import exit as sys_exit
-from typing import Callable, Optional, TypeVar, Union
+from sys import argv, exit as sys_exit
+from threading import Event, Thread
+from time import perf_counter
+from types import SimpleNamespace
+from typing import Callable, Iterable, Iterator, Optional, Union
 from uuid import UUID
 
 from decouple import RepositoryEnv
 from pytz import timezone
 from rich import get_console
 from rich.progress import _TrackThread, Progress  # noqa
-from sqlalchemy import create_engine
+from rich.table import Table
+from sqlalchemy import (
+    bindparam,
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    or_,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url, URL
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import Session
 from yaml import safe_load
 
+from script_archive import is_script_archive, iter_script_archive, write_script_archive
+
 # variables
 GITHUB_URL = "https://www.github.com/MrAryanDev"
 TELEGRAM_URL = "https://t.me/MrAryanDevChan"
@@ -33,6 +66,7 @@ REPO_URL = f"{GITHUB_URL}/{REPO_NAME}"
 
 SCRIPTS_DIR = "/opt/MrAryanDev"
 SCRIPT_DB_PATH = "/root/marzban2marzneshin.db"
+SCRIPT_ARCHIVE_PATH = "/root/marzban2marzneshin.m2m"
 
 PYTHON_EXECUTABLE = f"{SCRIPTS_DIR}/.venv/bin/python"
 CONFIGS_DIR = f"{SCRIPTS_DIR}/.config"
@@ -60,7 +94,7 @@ User=root
 WorkingDirectory={SCRIPT_DIR}
 ExecStart={PYTHON_EXECUTABLE} "{SOURCE_UPDATER_FILE_PATH}"
 Restart=always
-RestartSec=3600
+RestartSec=10
 StandardOutput=append:{SOURCE_UPDATER_LOG_PATH}
 StandardError=append:{SOURCE_UPDATER_LOG_PATH}
 
@@ -80,12 +114,127 @@ MARZNESHIN_DOCKER_COMPOSE_PATH = "/etc/opt/marzneshin/docker-compose.yml"
 MARZNESHIN_DOCKER_COMPOSE_ENV_PATH = ("services", "marzneshin", "environment")
 MARZNESHIN_DB_KEY = "SQLALCHEMY_DATABASE_URL"
 
+EXPORT_BATCH_SIZE = 1000
+EXPORT_USAGES_BATCH_SIZE = 10000
+EXPORT_SHARDS_PER_WORKER = 4
+IMPORT_BATCH_SIZE = 1000
+IMPORT_USAGES_BATCH_SIZE = 10000
+DIRECT_QUEUE_SIZE = 4  # batches read from marzban ahead of the importer
+IMPORT_QUEUE_SIZE = 4  # usage pages read from the script database ahead of the marzneshin writes
+
+# the marzban and marzneshin engines, only a few connections are used at the same time
+ENGINE_POOL_SIZE = 2
+ENGINE_MAX_OVERFLOW = 2
+ENGINE_POOL_RECYCLE = 3600  # seconds, under the mysql wait_timeout
+ENGINE_FETCH_SIZE = 1000  # rows fetched at once from the streamed results
+# the server waits for the client that reads a streamed result while it writes a batch
+MYSQL_SESSION_VARIABLES = (
+    "SET SESSION net_read_timeout = 600",
+    "SET SESSION net_write_timeout = 600",
+)
+# the importer writes the rows after the rows they refer to, they are checked at the end
+MYSQL_BULK_LOAD_SESSION_VARIABLES = ("SET SESSION foreign_key_checks = 0",)
+
+# the usages are imported by asyncio engines when the async driver of the database is installed
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "mysql": "aiomysql",
+    "mariadb": "aiomysql",
+    "postgresql": "asyncpg",
+}
+
+ROLLUP_PERIODS = ("day", "month")
+DEFAULT_ROLLUP_AGE = 30  # days
+UPSERT_CHUNK_SIZE = 5000
+
+QUERY_STATS_TOP_COUNT = 10
+
+# the script database is written once in bulk and can be exported again if the
+# server crashes, so the durability is traded for the write speed
+SCRIPT_DB_BULK_LOAD_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-65536",  # 64 megabytes
+    "PRAGMA temp_store=MEMORY",
+)
+# built after the bulk load, the importer reads the users of an admin and the usages of users
+SCRIPT_DB_INDEXES = (
+    ("ix_users_admin_id", "users", "admin_id"),
+    ("ix_node_user_usages_user_id", "node_user_usages", "user_id"),
+)
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+CLI_DEFAULTS = {
+    "export": dict(
+        protocol="vless",
+        non_uuid="revoke",
+        workers=1,
+        db_uri=None,
+        subscription_url_prefix=None,
+        format="sqlite",
+        rollup=None,
+        rollup_age=DEFAULT_ROLLUP_AGE,
+        output=None,
+        batch_size=EXPORT_BATCH_SIZE,
+        usages_batch_size=EXPORT_USAGES_BATCH_SIZE,
+        stats=None,
+    ),
+    "direct": dict(
+        protocol="vless",
+        non_uuid="revoke",
+        rollup=None,
+        rollup_age=DEFAULT_ROLLUP_AGE,
+        marzban_db_uri=None,
+        subscription_url_prefix=None,
+        target="new",
+        admins=None,
+        users=None,
+        db_uri=None,
+        batch_size=IMPORT_BATCH_SIZE,
+        usages_batch_size=IMPORT_USAGES_BATCH_SIZE,
+        stats=None,
+        incremental=False,
+        source_updater=True,
+    ),
+    "import": dict(
+        input=None,
+        target="new",
+        admins=None,
+        users=None,
+        db_uri=None,
+        batch_size=IMPORT_BATCH_SIZE,
+        usages_batch_size=IMPORT_USAGES_BATCH_SIZE,
+        stats=None,
+        reimport=False,
+        incremental=False,
+        source_updater=True,
+    ),
+}
+CLI_CHOICES = {
+    "protocol": ("vless", "vmess"),
+    "non_uuid": ("revoke", "skip"),
+    "format": ("sqlite", "compressed"),
+    "rollup": ROLLUP_PERIODS,
+    "target": ("new", "old"),
+    "admins": ("rename", "update", "skip"),
+    "users": ("rename", "update", "skip"),
+}
+QUERY_SHAPE_PATTERNS = (
+    (re_compile(r"\s+"), " "),
+    # in lists and values rows of any length have the same shape
+    (re_compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)"), "(?)"),
+    (re_compile(r"(VALUES \(\?\))(?:, \(\?\))+", IGNORECASE), r"\1"),
+)
+QUERY_TABLE_PATTERN = re_compile(r"\b(?:FROM|INTO|UPDATE)\s+[`\"]?(\w+)", IGNORECASE)
+
 
 CONSOLE = get_console()
 CONSOLE.style = "bold"
 
-_T = TypeVar("_T")
-
 
 def clear() -> None:
     """
@@ -191,12 +340,15 @@ def panel() -> None:
                 "Select an option:",
                 marzban_exporter="exporter",
                 marzneshin_importer="importer",
+                direct_migration="direct",
                 exit=lambda : sys_exit(0),
             )
             if option == "exporter":
                 marzban_exporter()
             elif option == "importer":
                 marzneshin_importer()
+            elif option == "direct":
+                direct_migrator()
             else:
                 error("Invalid option")
         except KeyboardInterrupt:
@@ -327,6 +479,142 @@ def check_sqlite_file(file_path: str) -> bool:
         return False
 
 
+def create_script_engine(db_path: str, bulk_load: bool = False) -> Engine:
+    """
+    Create the engine of a script database, tuned for writing it in bulk if bulk_load
+    """
+    engine = create_engine(f"sqlite:///{db_path}")
+    if bulk_load:
+
+        @event.listens_for(engine, "connect")
+        def set_bulk_load_pragmas(dbapi_connection, _) -> None:
+            cursor = dbapi_connection.cursor()
+            for pragma in SCRIPT_DB_BULK_LOAD_PRAGMAS:
+                cursor.execute(pragma)
+            cursor.close()
+
+    return engine
+
+
+def create_database_engine(db_uri: Union[str, URL], bulk_load: bool = False) -> Engine:
+    """
+    Create the engine of a marzban or marzneshin database, tuned for writing it in bulk if bulk_load
+    """
+    url = make_url(db_uri)
+    engine = create_engine(url, **database_engine_options())
+    set_session_variables(engine, url, bulk_load)
+    return engine
+
+
+def database_engine_options(stream_results: bool = True) -> dict:
+    """
+    Get the pool and streaming options of the marzban and marzneshin engines
+    """
+    options = dict(
+        pool_pre_ping=True,
+        pool_size=ENGINE_POOL_SIZE,
+        max_overflow=ENGINE_MAX_OVERFLOW,
+        pool_recycle=ENGINE_POOL_RECYCLE,
+    )
+    if stream_results:
+        # the rows are streamed from server side cursors instead of buffering the whole result
+        options["execution_options"] = dict(stream_results=True, max_row_buffer=ENGINE_FETCH_SIZE)
+    return options
+
+
+def set_session_variables(engine: Engine, url: URL, bulk_load: bool = False) -> None:
+    """
+    Set the mysql session variables on the new connections of the engine
+    """
+    if url.get_backend_name() not in ("mysql", "mariadb"):
+        return
+    variables = MYSQL_SESSION_VARIABLES
+    if bulk_load:
+        variables += MYSQL_BULK_LOAD_SESSION_VARIABLES
+
+    @event.listens_for(engine, "connect")
+    def set_mysql_session_variables(dbapi_connection, _) -> None:
+        cursor = dbapi_connection.cursor()
+        for variable in variables:
+            cursor.execute(variable)
+        cursor.close()
+
+
+def create_script_indexes(session: Union[Session, Engine]) -> None:
+    """
+    Create the indexes of the script database if they do not exist
+    """
+    for name, table, column in SCRIPT_DB_INDEXES:
+        session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
+
+
+def finish_script_db(engine: Engine) -> None:
+    """
+    Index the bulk loaded script database and make it a single file again, so it can be copied
+    """
+    with engine.begin() as connection:
+        create_script_indexes(connection)
+    engine.dispose()
+
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+    engine.dispose()
+
+
+def check_datastore_file(file_path: str) -> bool:
+    """
+    Check if the file is a sqlite or compressed datastore
+    """
+    return exists(file_path) and (is_script_archive(file_path) or check_sqlite_file(file_path))
+
+
+def default_datastore_path() -> str:
+    """
+    Get the default datastore path, the compressed one if only it exists
+    """
+    if exists(SCRIPT_ARCHIVE_PATH) and not exists(SCRIPT_DB_PATH):
+        return SCRIPT_ARCHIVE_PATH
+    return SCRIPT_DB_PATH
+
+
+def open_datastore(file_path: str) -> str:
+    """
+    Get the sqlite datastore of the file, a compressed datastore is loaded to a sqlite file next to it
+    """
+    if not is_script_archive(file_path):
+        return file_path
+
+    # the loaded datastore keeps the import checkpoint, it is loaded again only
+    # if the compressed datastore is changed
+    db_path = f"{file_path}.db"
+    if exists(db_path) and getmtime(db_path) >= getmtime(file_path):
+        return db_path
+
+    info(f"Loading the compressed datastore to {db_path}")
+    load_script_archive(file_path, db_path)
+    return db_path
+
+
+def load_script_archive(archive_path: str, db_path: str) -> None:
+    """
+    Load a compressed datastore to a new sqlite datastore
+    """
+    import script_models as script
+
+    engine = create_script_engine(f"{db_path}.part", True)
+    try:
+        script.Base.metadata.drop_all(engine)
+        script.Base.metadata.create_all(engine)
+        with Session(engine) as ss:
+            write_script_rows(ss, iter_script_archive(archive_path))
+        finish_script_db(engine)
+    except:  # noqa
+        engine.dispose()
+        remove(f"{db_path}.part")
+        raise
+    replace(f"{db_path}.part", db_path)
+
+
 def get_file_path(
     file_name: str, default_path: str = None, checker: Callable[[str], bool] = exists
 ) -> str:
@@ -342,42 +630,52 @@ def get_file_path(
         error(f"{file_path} is invalid")
 
 
-def exists_checker_generator(
-    session: Session, model: _T, return_model: bool = False, main_key: str = "username"
-) -> Callable[..., Union[bool, _T]]:
+class ExistsIndex:
     """
-    Check if admin exists
+    Preloaded in-memory index of the values of a column
     """
 
-    def f(*args, **kwargs) -> bool:
+    def __init__(self, session: Session, key_column, value_column=None) -> None:
+        # mysql compares strings case-insensitively, the index must do the same
+        self.case_insensitive = session.get_bind().dialect.name in ("mysql", "mariadb")
+        self.values = {}
+        columns = (key_column,) if value_column is None else (key_column, value_column)
+        for row in session.execute(select(*columns)):
+            if row[0] is not None:
+                self.add(row[0], row[1] if len(row) > 1 else True)
+
+    def _key(self, key: str) -> str:
+        return key.lower() if self.case_insensitive else key
+
+    def __call__(self, key: str) -> bool:
+        """
+        Check if the key exists
+        """
+        return self._key(key) in self.values
+
+    def get(self, key: str):
         """
-        Check if the username exists
+        Get the value of the key
         """
-        if args:
-            kwargs.update({main_key: args[0]})
-        if return_model:
-            return session.query(model).filter_by(**kwargs).first()
-        return session.query(session.query(model).filter_by(**kwargs).exists()).scalar()
+        return self.values.get(self._key(key))
 
-    return f
+    def add(self, key: str, value=True) -> None:
+        """
+        Add the key to the index
+        """
+        self.values[self._key(key)] = value
 
 
 def user_key(
-    session: Session, user_id: int, proxy_model, protocol: str, _re_search: bool = True
+    proxies: dict, protocol: str, _re_search: bool = True
 ) -> Optional[str]:
     """
-    Generate a key for the user
+    Generate a key for the user from its preloaded proxies settings
     """
-    proxy_settings = (
-        session.query(proxy_model.settings)
-        .filter_by(user_id=user_id, type=protocol)
-        .scalar()
-    )
+    proxy_settings = proxies.get(protocol)
     if proxy_settings is None and _re_search:
         return user_key(
-            session,
-            user_id,
-            proxy_model,
+            proxies,
             "vless" if protocol == "vmess" else "vmess",
             False,
         )
@@ -393,6 +691,699 @@ def user_key(
         return UUID(proxy_uuid).hex
 
 
+def iter_keyset_pages(
+    session: Session,
+    model,
+    batch_size: int,
+    *criteria,
+    columns: tuple = (),
+    after_id: int = 0,
+) -> Iterator[list]:
+    """
+    Iterate over the rows of a model page by page, ordered by id
+    """
+    last_id = after_id or 0
+    while page := get_keyset_page(
+        session, model, batch_size, *criteria, columns=columns, after_id=last_id
+    ):
+        yield page
+        last_id = page[-1].id
+
+
+def get_keyset_page(
+    session: Session,
+    model,
+    batch_size: int,
+    *criteria,
+    columns: tuple = (),
+    after_id: int = 0,
+) -> list:
+    """
+    Get the page of the rows of a model after the id
+    """
+    return (
+        session.query(*(columns or (model,)))
+        .filter(model.id > after_id, *criteria)
+        .order_by(model.id)
+        .limit(batch_size)
+        .all()
+    )
+
+
+def peak_memory_usage() -> int:
+    """
+    Get the peak resident memory of the process in bytes
+    """
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+class QueryStats:
+    """
+    Count and time the statements of the engines per phase, database, table and statement shape
+    """
+
+    def __init__(self, top_count: int = QUERY_STATS_TOP_COUNT) -> None:
+        self.top_count = top_count
+        self.reset()
+
+    def reset(self) -> None:
+        self.phase = "other"
+        self.phase_started_at = perf_counter()
+        self.phases = {}  # phase: seconds, queries and seconds of each database
+        self.shapes = {}  # (database, table, shape): [queries, seconds]
+        self.slowest = []  # heap of (seconds, phase, database, shape)
+
+    def attach(self, engine: Engine, database: str) -> None:
+        """
+        Record the statements of the engine under the database name
+        """
+
+        def before_cursor_execute(conn, *_) -> None:
+            conn.info["query_started_at"] = perf_counter()
+
+        def after_cursor_execute(conn, cursor, statement, *_) -> None:
+            self.record(database, statement, perf_counter() - conn.info["query_started_at"])
+
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    def get_phase(self, name: str) -> dict:
+        return self.phases.setdefault(name, dict(seconds=0.0, queries=0, databases={}))
+
+    def start_phase(self, name: str) -> None:
+        """
+        Count the time and the next statements for the phase
+        """
+        now = perf_counter()
+        self.get_phase(self.phase)["seconds"] += now - self.phase_started_at
+        self.phase, self.phase_started_at = name, now
+
+    def record(self, database: str, statement: str, seconds: float) -> None:
+        phase = self.get_phase(self.phase)
+        phase["queries"] += 1
+        phase["databases"][database] = phase["databases"].get(database, 0.0) + seconds
+
+        shape = statement.strip()
+        for pattern, replacement in QUERY_SHAPE_PATTERNS:
+            shape = pattern.sub(replacement, shape)
+        table = QUERY_TABLE_PATTERN.search(shape)
+        key = (database, table.group(1) if table else "-", shape)
+        shape_stats = self.shapes.setdefault(key, [0, 0.0])
+        shape_stats[0] += 1
+        shape_stats[1] += seconds
+
+        slow = (seconds, self.phase, database, shape)
+        if len(self.slowest) < self.top_count:
+            heappush(self.slowest, slow)
+        elif seconds > self.slowest[0][0]:
+            heappushpop(self.slowest, slow)
+
+    def report(self) -> dict:
+        """
+        Get the phases, the most time consuming statement shapes and the slowest statements
+        """
+        self.start_phase("other")
+        phases = {}
+        for name, phase in self.phases.items():
+            phases[name] = dict(
+                phase,
+                # the time that is not spent in the databases is spent in python
+                python_seconds=max(phase["seconds"] - sum(phase["databases"].values()), 0.0),
+            )
+        shapes = sorted(self.shapes.items(), key=lambda item: item[1][1], reverse=True)
+        return dict(
+            phases=phases,
+            shapes=[
+                dict(database=database, table=table, shape=shape, queries=queries, seconds=seconds)
+                for (database, table, shape), (queries, seconds) in shapes[: self.top_count]
+            ],
+            slowest=[
+                dict(seconds=seconds, phase=phase, database=database, shape=shape)
+                for seconds, phase, database, shape in sorted(self.slowest, reverse=True)
+            ],
+        )
+
+    def print_report(self, report: dict) -> None:
+        databases = sorted(
+            {database for phase in report["phases"].values() for database in phase["databases"]}
+        )
+        table = Table(title="Phases")
+        for column in ("phase", "seconds", "queries", *databases, "python"):
+            table.add_column(column)
+        for name, phase in report["phases"].items():
+            table.add_row(
+                name,
+                f"{phase['seconds']:.2f}",
+                str(phase["queries"]),
+                *(f"{phase['databases'].get(database, 0.0):.2f}" for database in databases),
+                f"{phase['python_seconds']:.2f}",
+            )
+        CONSOLE.print(table)
+
+        table = Table(title="Statements")
+        for column in ("database", "table", "queries", "seconds"):
+            table.add_column(column, no_wrap=True)
+        table.add_column("statement", max_width=36, no_wrap=True, overflow="ellipsis")
+        for shape in report["shapes"]:
+            table.add_row(
+                shape["database"],
+                shape["table"],
+                str(shape["queries"]),
+                f"{shape['seconds']:.2f}",
+                shape["shape"][:80],
+            )
+        CONSOLE.print(table)
+
+        table = Table(title="Slowest statements")
+        for column in ("seconds", "phase", "database"):
+            table.add_column(column, no_wrap=True)
+        table.add_column("statement", max_width=36, no_wrap=True, overflow="ellipsis")
+        for slow in report["slowest"]:
+            table.add_row(f"{slow['seconds']:.3f}", slow["phase"], slow["database"], slow["shape"][:80])
+        CONSOLE.print(table)
+
+
+QUERY_STATS = QueryStats()
+
+
+def save_query_stats(stats_path: Optional[str] = None, ask: bool = True) -> None:
+    """
+    Print the query statistics and save them to a file if the user wants
+    """
+    report = QUERY_STATS.report()
+    QUERY_STATS.print_report(report)
+
+    if ask:
+        info("Leave it empty to not save the statistics")
+        stats_path = get_input("Enter the path to save the query statistics")
+    if stats_path:
+        with open(stats_path, "w") as file:
+            dump(report, file, indent=2)
+
+
+def upsert_statement(
+    session: Session, table, index_elements: tuple, columns: tuple, add: bool = False
+):
+    """
+    Build an insert statement that updates the columns of the existing row with the same unique key
+    """
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name in ("mysql", "mariadb"):
+        statement = mysql_insert(table)
+        inserted = statement.inserted
+    elif dialect_name in ("sqlite", "postgresql"):
+        statement = (sqlite_insert if dialect_name == "sqlite" else postgresql_insert)(table)
+        inserted = statement.excluded
+    else:
+        raise ValueError(f"Unsupported database dialect: {dialect_name}")
+
+    values = {
+        column: table.c[column] + inserted[column] if add else inserted[column]
+        for column in columns
+    }
+    if dialect_name in ("mysql", "mariadb"):
+        return statement.on_duplicate_key_update(values)
+    return statement.on_conflict_do_update(index_elements=index_elements, set_=values)
+
+
+def insert_returning_ids(session: Session, table, rows: list, key_column: str) -> dict:
+    """
+    Insert the rows and get the ids that the database gave them by their unique key
+    """
+    if session.get_bind().dialect.insert_executemany_returning:
+        result = session.execute(
+            insert(table).returning(table.c[key_column], table.c.id), rows
+        )
+    else:
+        # mysql has no returning, the rows are read back by their unique key
+        session.execute(insert(table), rows)
+        result = session.execute(
+            select(table.c[key_column], table.c.id).where(
+                table.c[key_column].in_([row[key_column] for row in rows])
+            )
+        )
+    return dict(result.all())
+
+
+def upsert_usages(
+    session: Session,
+    table,
+    rows: Iterable[dict],
+    index_elements: tuple,
+    sum_columns: tuple,
+    progress: _TrackThread,
+    chunk_size: int = UPSERT_CHUNK_SIZE,
+) -> None:
+    """
+    Insert the usages, adding them to the existing usages of the same unique key
+    """
+    statement = upsert_statement(session, table, index_elements, sum_columns, True)
+
+    chunk = []
+    for row in rows:
+        progress.completed += 1
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            session.execute(statement, chunk)
+            chunk = []
+    if chunk:
+        session.execute(statement, chunk)
+
+
+class UsageRollup:
+    """
+    Roll the usages older than an age up to daily or monthly usages, counting the rolled up rows
+    """
+
+    def __init__(self, period: str, age: int, now: Optional[datetime] = None) -> None:
+        if period not in ROLLUP_PERIODS:
+            raise ValueError(f"rollup period must be one of {', '.join(ROLLUP_PERIODS)}")
+        self.period = period
+        self.age = age
+
+        # the usages are rolled up before the start of a period, so the hourly
+        # usages after it never share a period with the rolled up usages
+        before = (now or datetime.utcnow()) - timedelta(days=age)  # noqa
+        before = before.replace(hour=0, minute=0, second=0, microsecond=0)
+        if period == "month":
+            before = before.replace(day=1)
+        self.before = before
+
+        self.rows = 0  # rolled up usages of marzban
+        self.buckets = 0  # usages they are rolled up to
+
+    @property
+    def eliminated(self) -> int:
+        return self.rows - self.buckets
+
+    def bucket(self, session: Session, column):
+        """
+        Get the start of the period of the column in the dialect of the session
+        """
+        dialect_name = session.get_bind().dialect.name
+        if dialect_name == "sqlite":
+            return func.strftime(self.bucket_format, column)
+        if dialect_name in ("mysql", "mariadb"):
+            return func.date_format(column, self.bucket_format)
+        return func.date_trunc(self.period, column)
+
+    @property
+    def bucket_format(self) -> str:
+        return "%Y-%m-%d 00:00:00" if self.period == "day" else "%Y-%m-01 00:00:00"
+
+    @staticmethod
+    def bucket_datetime(value) -> datetime:
+        if isinstance(value, str):
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+        return value
+
+    def add(self, rows: int, buckets: int) -> None:
+        self.rows += rows
+        self.buckets += buckets
+
+    def report(self) -> None:
+        info(
+            f"{self.rows} usages older than {self.before:%Y-%m-%d} are rolled up to"
+            f" {self.buckets} {'daily' if self.period == 'day' else 'monthly'} usages, {self.eliminated} rows are eliminated"
+        )
+
+
+def marzban_panel_id(jwt_secret_key: str) -> str:
+    """
+    Get the id of a marzban panel from its jwt secret key, the subscription route computes the same id
+    """
+    return sha256(jwt_secret_key.encode()).hexdigest()[:16]
+
+
+def usage_probe(
+    session: Session, table, rows: list, index_elements: tuple, sum_columns: tuple
+) -> Optional[dict]:
+    """
+    Get a probe that shows whether the merged usages are committed
+    """
+    for row in rows:
+        if sum(row[column] or 0 for column in sum_columns) > 0:
+            break
+    else:
+        return None  # merging zero usages again changes nothing
+
+    merged = session.execute(
+        select(table.c.id, *(table.c[column] for column in sum_columns)).where(
+            *(table.c[column] == row[column] for column in index_elements)
+        )
+    ).first()
+    return dict(
+        table=table.name,
+        id=merged[0],
+        columns=list(sum_columns),
+        value=sum(value or 0 for value in merged[1:]),
+    )
+
+
+def import_chunk_committed(session: Session, probe: Optional[dict]) -> bool:
+    """
+    Check the probe of a chunk against the marzneshin database
+    """
+    import marzneshin_models as marzneshin
+
+    if probe is None:
+        return False
+
+    table = marzneshin.Base.metadata.tables[probe["table"]]
+    key_column = list(table.primary_key)[0]
+    row = session.execute(
+        select(key_column, *(table.c[column] for column in probe["columns"])).where(
+            key_column == probe["id"]
+        )
+    ).first()
+    if row is None:
+        return False
+    return probe["value"] is None or sum(value or 0 for value in row[1:]) == probe["value"]
+
+
+def load_import_checkpoint(ms: Session, ss: Session, target: str):
+    """
+    Load the import checkpoint of the marzneshin database, resolving the chunk that was committing
+    """
+    import script_models as script
+
+    script.Base.metadata.create_all(
+        ss.get_bind(),
+        tables=[script.ImportCheckpoint.__table__, script.ImportedUser.__table__],
+    )
+
+    checkpoint = ss.query(script.ImportCheckpoint).filter_by(target=target).first()
+    if checkpoint is None:
+        checkpoint = script.ImportCheckpoint(target=target)
+        ss.add(checkpoint)
+    elif checkpoint.pending is not None:
+        if import_chunk_committed(ms, checkpoint.pending["probe"]):
+            for key, value in checkpoint.pending.items():
+                if key != "probe":
+                    setattr(checkpoint, key, value)
+        checkpoint.pending = None
+    ss.commit()
+    return checkpoint
+
+
+def reset_import_checkpoint(ss: Session, checkpoint) -> None:
+    """
+    Forget the import progress, to import the datastore from the beginning
+    """
+    import script_models as script
+
+    ss.execute(
+        delete(script.ImportedUser).where(
+            script.ImportedUser.target == checkpoint.target
+        )
+    )
+    checkpoint.stage = script.ImportStage.users.value
+    checkpoint.admin_id = 0
+    checkpoint.marzneshin_admin_id = None
+    checkpoint.user_id = 0
+    checkpoint.usage_id = 0
+    checkpoint.pending = None
+    ss.commit()
+
+
+def commit_import_chunk(
+    ms: Session,
+    ss: Session,
+    checkpoint,
+    probe: Optional[dict] = None,
+    imported_users: Optional[list] = None,
+    **state,
+) -> None:
+    """
+    Commit a chunk of the import and move the checkpoint past it
+    """
+    import script_models as script
+
+    # the checkpoint is stored as pending first, if the process dies after the
+    # marzneshin commit, the probe shows that the chunk must not be merged again
+    checkpoint.pending = dict(state, probe=probe)
+    if imported_users:
+        statement = sqlite_insert(script.ImportedUser.__table__)
+        ss.execute(
+            statement.on_conflict_do_update(
+                index_elements=("target", "user_id"),
+                set_={"marzneshin_user_id": statement.excluded.marzneshin_user_id},
+            ),
+            imported_users,
+        )
+    ss.commit()
+
+    try:
+        ms.commit()
+    except Exception as e:
+        ms.rollback()
+        raise e
+
+    for key, value in state.items():
+        setattr(checkpoint, key, value)
+    checkpoint.pending = None
+    ss.commit()
+
+
+def get_marzban_sync(ms: Session, panel_id: str):
+    """
+    Get the sync state of the last import of a marzban panel, creating the state tables if needed
+    """
+    import marzneshin_models as marzneshin
+
+    for table in (
+        marzneshin.MarzbanAdmin.__table__,
+        marzneshin.MarzbanSync.__table__,
+        marzneshin.MarzbanSyncUsage.__table__,
+    ):
+        table.create(ms.connection(), checkfirst=True)
+    ms.commit()
+
+    return ms.get(marzneshin.MarzbanSync, panel_id)
+
+
+class SyncWindow:
+    """
+    The part of a datastore to import, only the changes since the last import of its panel if it is incremental
+    """
+
+    def __init__(self, ms: Session, ss: Session, panel_id: str, incremental: bool) -> None:
+        import marzneshin_models as marzneshin
+        import script_models as script
+
+        script.ExportInfo.__table__.create(ss.connection(), checkfirst=True)
+        export_info = ss.query(script.ExportInfo).first()
+        state = get_marzban_sync(ms, panel_id)
+
+        self.panel_id = panel_id
+        # the datastores of the older exporters do not know when they are exported
+        self.exported_at = export_info.exported_at if export_info else None
+        # the usages of the hour that the export started in may still grow
+        self.until = self.exported_at and self.exported_at.replace(
+            minute=0, second=0, microsecond=0
+        )
+
+        # the first import of a panel imports everything
+        self.incremental = incremental and state is not None
+        if state is not None and not incremental:
+            warning("This Marzban is imported before, its usages and traffic are added again")
+        self.since = None
+        self.user_id = 0
+        self.usages_since = None
+        self.uplink = self.downlink = 0
+        self.partial_usages = []
+        if not self.incremental:
+            return
+
+        if self.exported_at is None:
+            error("The datastore is exported by an older version, export it again", True)
+        if self.exported_at < state.exported_at:
+            error("The datastore is exported before the last import of this Marzban", True)
+        if export_info.rolled_up_before and export_info.rolled_up_before > state.usages_since:
+            error(
+                f"The usages after the last import ({state.usages_since:%Y-%m-%d %H:%M}) are rolled up,"
+                f" export it again with a larger rollup age",
+                True,
+            )
+
+        self.since = state.exported_at
+        self.user_id = state.user_id
+        self.usages_since = state.usages_since
+        self.uplink = state.uplink
+        self.downlink = state.downlink
+        sync_usages_table = marzneshin.MarzbanSyncUsage.__table__
+        self.partial_usages = [
+            usage._asdict()
+            for usage in ms.execute(
+                select(sync_usages_table).where(sync_usages_table.c.panel == panel_id)
+            )
+        ]
+
+    def users_criteria(self) -> list:
+        """
+        Get the criteria of the users that are new or changed since the last import
+        """
+        import script_models as script
+
+        if not self.incremental:
+            return []
+        return [
+            or_(
+                script.User.id > self.user_id,
+                *(
+                    column >= self.since
+                    for column in (
+                        script.User.created_at,
+                        script.User.edit_at,
+                        script.User.online_at,  # marzban sets it with the used traffic
+                        script.User.sub_updated_at,
+                        script.User.sub_revoked_at,
+                        script.User.traffic_reset_at,
+                    )
+                ),
+            )
+        ]
+
+    def usages_criteria(self, column) -> list:
+        """
+        Get the criteria of the usages that are not complete in the last import
+        """
+        if not self.incremental:
+            return []
+        return [column >= self.usages_since]
+
+    def new_usages(self, rows: list) -> list:
+        """
+        Filter the usage rows by the usages criteria
+        """
+        if not self.incremental:
+            return rows
+        return [row for row in rows if row["created_at"] >= self.usages_since]
+
+    def synced(self, ms: Session, id_column, marzneshin_id_column) -> dict:
+        """
+        Get the marzban usernames of the panel that are imported before and still exist in marzneshin
+        """
+        if not self.incremental:
+            return {}
+        model = id_column.class_
+        return dict(
+            ms.query(model.username, id_column)
+            .join(marzneshin_id_column.class_, marzneshin_id_column == id_column)
+            .filter(model.panel == self.panel_id)
+        )
+
+    def stage_partial_usages(self, ss: Session, table_name: str, rows: list) -> None:
+        """
+        Keep the usages of the incomplete hours in the script database, for the direct migration
+        """
+        if self.until is None:
+            return
+        partial_usages = [row for row in rows if row["created_at"] >= self.until]
+        if partial_usages:
+            write_script_rows(ss, ((table_name, partial_usages),))
+
+    def save(self, ms: Session, ss: Session, checkpoint, system, first_node_id: int) -> Optional[dict]:
+        """
+        Keep the high-water marks of the import, in the transaction of the system traffic, and get its probe
+        """
+        import marzneshin_models as marzneshin
+        import script_models as script
+
+        if self.exported_at is None:
+            return None
+
+        # the incomplete hours of the last import are merged again completely,
+        # so what was merged of them then is taken back
+        user_node_usages_table = marzneshin.NodeUserUsage.__table__
+        node_usages_table = marzneshin.NodeUsage.__table__
+        for table, key_columns, sum_columns, partial_usages in (
+            (
+                user_node_usages_table,
+                ("created_at", "user_id", "node_id"),
+                ("used_traffic",),
+                [usage for usage in self.partial_usages if usage["user_id"]],
+            ),
+            (
+                node_usages_table,
+                ("created_at", "node_id"),
+                ("uplink", "downlink"),
+                [usage for usage in self.partial_usages if not usage["user_id"]],
+            ),
+        ):
+            if partial_usages:
+                ms.execute(
+                    update(table)
+                    .where(*(table.c[column] == bindparam(f"_{column}") for column in key_columns))
+                    .values({column: table.c[column] - bindparam(f"_{column}") for column in sum_columns}),
+                    [
+                        {f"_{column}": usage[column] for column in key_columns + sum_columns}
+                        for usage in partial_usages
+                    ],
+                )
+
+        state = ms.get(marzneshin.MarzbanSync, self.panel_id)
+        if state is None:
+            state = marzneshin.MarzbanSync(panel=self.panel_id, imports=0)
+            ms.add(state)
+        state.exported_at = self.exported_at
+        state.user_id = max(self.user_id, ss.query(func.max(script.User.id)).scalar() or 0)
+        state.usages_since = self.until
+        state.uplink = system.uplink if system else 0
+        state.downlink = system.downlink if system else 0
+        state.imports += 1
+
+        ms.execute(
+            delete(marzneshin.MarzbanSyncUsage).where(
+                marzneshin.MarzbanSyncUsage.panel == self.panel_id
+            )
+        )
+        partial_usages = [
+            dict(
+                panel=self.panel_id,
+                user_id=user_id,
+                created_at=created_at,
+                node_id=first_node_id,
+                used_traffic=used_traffic,
+                uplink=0,
+                downlink=0,
+            )
+            for user_id, created_at, used_traffic in ss.query(
+                script.ImportedUser.marzneshin_user_id,
+                script.NodeUserUsage.created_at,
+                func.sum(script.NodeUserUsage.used_traffic),
+            )
+            .filter(
+                script.ImportedUser.target == checkpoint.target,
+                script.ImportedUser.user_id == script.NodeUserUsage.user_id,
+                script.NodeUserUsage.created_at >= self.until,
+            )
+            .group_by(script.ImportedUser.marzneshin_user_id, script.NodeUserUsage.created_at)
+        ] + [
+            dict(
+                panel=self.panel_id,
+                user_id=0,
+                created_at=created_at,
+                node_id=first_node_id,
+                used_traffic=0,
+                uplink=uplink,
+                downlink=downlink,
+            )
+            for created_at, uplink, downlink in ss.query(
+                script.NodeUsage.created_at,
+                func.sum(script.NodeUsage.uplink),
+                func.sum(script.NodeUsage.downlink),
+            )
+            .filter(script.NodeUsage.created_at >= self.until)
+            .group_by(script.NodeUsage.created_at)
+        ]
+        if partial_usages:
+            ms.execute(insert(marzneshin.MarzbanSyncUsage), partial_usages)
+        ms.flush()
+
+        return dict(table="marzban_syncs", id=self.panel_id, columns=["imports"], value=state.imports)
+
+
 def get_total(session: Session, models) -> int:
     admins_count = session.query(models.Admin).count()
     users_count = session.query(models.User).count()
@@ -416,13 +1407,65 @@ def marzban_exporter() -> None:
     """
     Export data from marzban
     """
-    import marzban_models as marzban
-    import script_models as script
-
     clear()
 
     check_marzban_requirements()
 
+    transform_protocol, non_uuid_handling, rollup = ask_export_options()
+
+    # datastore format
+    info("The compressed datastore is smaller and faster to copy, but it is exported by one process")
+    datastore_format = selector(
+        "Which format should the datastore be saved in?",
+        "sqlite",
+        "compressed",
+    )
+
+    clear()
+
+    if datastore_format == "sqlite":
+        script_db_path = SCRIPT_DB_PATH
+
+        # export workers count
+        info(f"Default is 1, this server has {cpu_count()} cpu cores")
+        while True:
+            workers = get_input("How many processes should export the users") or "1"
+            if workers.isdigit() and int(workers) > 0:
+                workers = int(workers)
+                break
+            error("Invalid number")
+
+        clear()
+    else:
+        script_db_path = SCRIPT_ARCHIVE_PATH
+        workers = 1
+
+    db_uri, subscription_url_prefix = get_marzban_settings()
+    export_marzban(
+        db_uri,
+        subscription_url_prefix,
+        transform_protocol,
+        non_uuid_handling,
+        workers,
+        script_db_path,
+        datastore_format=datastore_format,
+        rollup=rollup,
+    )
+
+    info(f"The datastore is saved to {script_db_path}")
+    if rollup:
+        rollup.report()
+    info(f"Peak memory usage: {peak_memory_usage() / 1024 / 1024:.1f} megabytes")
+    save_query_stats()
+
+    print("\n\n")
+    input("Press Enter to continue...")
+
+
+def ask_export_options() -> tuple:
+    """
+    Ask the priority protocol and the handling of the users without uuid
+    """
     # transfer vless or vmess
     warning(
         "It is only possible to transfer users who were using the [u]VLESS[/] or [u]VMESS[/] protocol in Marzban."
@@ -449,8 +1492,34 @@ def marzban_exporter() -> None:
 
     clear()
 
-    # get the database uri and subscription url prefix from docker compose
-    with open(MARZBAN_DOCKER_COMPOSE_PATH, encoding="utf-8") as file:
+    # usages rollup
+    info("The hourly usages of users are the most rows, the old ones can be kept daily or monthly")
+    rollup_period = selector(
+        "Should the old usages be rolled up?",
+        "no",
+        "day",
+        "month",
+    )
+    rollup = None
+    if rollup_period != "no":
+        info(f"Default is {DEFAULT_ROLLUP_AGE} days")
+        while True:
+            age = get_input("How many days old usages should be rolled up") or str(DEFAULT_ROLLUP_AGE)
+            if age.isdigit():
+                rollup = UsageRollup(rollup_period, int(age))
+                break
+            error("Invalid number")
+
+    clear()
+
+    return transform_protocol, non_uuid_handling, rollup
+
+
+def get_marzban_settings() -> tuple:
+    """
+    Get the database uri and subscription url prefix of marzban from its docker compose or .env file
+    """
+    with open(MARZBAN_DOCKER_COMPOSE_PATH, encoding="utf-8") as file:
         environment = safe_load(file)
     for key in MARZBAN_DOCKER_COMPOSE_ENV_PATH:
         environment = environment.get(key, {})
@@ -476,148 +1545,656 @@ def marzban_exporter() -> None:
 
         del repository
 
-    ms = Session(create_engine(db_uri), autoflush=False)
+    return db_uri, subscription_url_prefix
+
+
+def export_marzban(
+    db_uri: str,
+    subscription_url_prefix: str,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    workers: int = 1,
+    script_db_path: str = SCRIPT_DB_PATH,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    datastore_format: str = "sqlite",
+    rollup: Optional[UsageRollup] = None,
+) -> None:
+    """
+    Export the marzban database to a new script database or compressed datastore
+    """
+    import marzban_models as marzban
+    import script_models as script
+
+    QUERY_STATS.reset()
+    ms = Session(create_database_engine(db_uri), autoflush=False)
+    QUERY_STATS.attach(ms.get_bind(), "marzban")
+
+    if datastore_format == "compressed":
+        with create_progress_bar("Exporting users", get_total(ms, marzban)) as progress:
+            write_script_archive(
+                script_db_path,
+                iter_marzban_data(
+                    ms,
+                    transform_protocol,
+                    non_uuid_handling,
+                    subscription_url_prefix,
+                    progress,
+                    batch_size,
+                    usages_batch_size,
+                    rollup,
+                ),
+            )
+        QUERY_STATS.start_phase("other")
+        ms.close()
+        return
 
-    __script_engine = create_engine(f"sqlite:///{SCRIPT_DB_PATH}")
+    __script_engine = create_script_engine(script_db_path, True)
+    QUERY_STATS.attach(__script_engine, "script")
     ss = Session(bind=__script_engine)
 
     script.Base.metadata.drop_all(__script_engine)
     script.Base.metadata.create_all(__script_engine)
 
-    tehran_tz = timezone("Asia/Tehran")
-
     with create_progress_bar("Exporting users", get_total(ms, marzban)) as progress:
-        admins = ms.query(marzban.Admin)
-        for admin in admins:
-            progress.completed += 1
+        export_marzban_data(
+            ms,
+            ss,
+            transform_protocol,
+            non_uuid_handling,
+            subscription_url_prefix,
+            progress,
+            workers,
+            batch_size,
+            usages_batch_size,
+            rollup,
+        )
 
-            users = ms.query(marzban.User).filter_by(admin_id=admin.id)
-            admin_users = []
-            for user in users:
-                progress.completed += 1
+    ms.close()
+    ss.close()
+    finish_script_db(__script_engine)
+
+
+def export_marzban_data(
+    ms: Session,
+    ss: Session,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    subscription_url_prefix: str,
+    progress: _TrackThread,
+    workers: int = 1,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    rollup: Optional[UsageRollup] = None,
+) -> None:
+    """
+    Stream the marzban data to the script database in bounded batches
+    """
+    write_script_rows(ss, iter_export_info(rollup))
+    write_script_rows(ss, iter_marzban_admins(ms, subscription_url_prefix, progress))
+
+    if workers > 1:
+        QUERY_STATS.start_phase("users")
+        export_marzban_users_parallel(
+            ms,
+            ss,
+            transform_protocol,
+            non_uuid_handling,
+            progress,
+            workers,
+            batch_size,
+            usages_batch_size,
+            rollup,
+        )
+    else:
+        export_marzban_users(
+            ms,
+            ss,
+            transform_protocol,
+            non_uuid_handling,
+            progress,
+            batch_size,
+            usages_batch_size,
+            rollup=rollup,
+        )
 
-                marzban_user_node_usages = ms.query(marzban.NodeUserUsage).filter_by(
-                    user_id=user.id
-                )
-                user_node_usages = []
-                for user_node_usage in marzban_user_node_usages:
-                    progress.completed += 1
-                    user_node_usages.append(
-                        script.NodeUserUsage(
-                            created_at=user_node_usage.created_at,  # noqa
-                            used_traffic=user_node_usage.used_traffic,  # noqa
-                        )
-                    )
-                del marzban_user_node_usages
+    write_script_rows(ss, iter_marzban_usages(ms, progress, usages_batch_size, rollup))
+    QUERY_STATS.start_phase("other")
 
-                key = user_key(ms, user.id, marzban.Proxy, transform_protocol)  # noqa
-                if not key and non_uuid_handling == "skip":
-                    continue
 
-                data_limit = user.data_limit or 0
-                used_traffic = user.used_traffic or 0
-                used_traffic = min(data_limit, used_traffic) if data_limit != 0 else used_traffic
-                usage_duration = 0
-                activation_deadline = None
-                expire_date = None
-                if user.status == marzban.UserStatus.on_hold:
-                    expire_strategy = script.UserExpireStrategy.START_ON_FIRST_USE
-                    usage_duration = user.on_hold_expire_duration
-                    activation_deadline = user.on_hold_timeout
-
-                elif not (user.expire is None):
-                    expire_strategy = script.UserExpireStrategy.FIXED_DATE
-                    expire_date = datetime.fromtimestamp(
-                        user.expire, tz=datetime_timezone.utc  # noqa
-                    ).astimezone(tehran_tz)
-                else:
-                    expire_strategy = script.UserExpireStrategy.NEVER
-
-                admin_users.append(
-                    script.User(
-                        username=user.username,  # noqa
-                        key=key,
-                        enabled=not user.status == marzban.UserStatus.disabled,
-                        expire_strategy=expire_strategy,
-                        expire_date=expire_date,
-                        usage_duration=usage_duration,
-                        activation_deadline=activation_deadline,  # noqa
-                        data_limit=data_limit,  # noqa
-                        data_limit_reset_strategy=user.data_limit_reset_strategy,
-                        note=user.note,  # noqa
-                        used_traffic=used_traffic,
-                        lifetime_used_traffic=user.lifetime_used_traffic,  # noqa
-                        sub_updated_at=user.sub_updated_at,  # noqa
-                        sub_revoked_at=user.sub_revoked_at,  # noqa
-                        sub_last_user_agent=user.sub_last_user_agent,  # noqa
-                        created_at=user.created_at,  # noqa
-                        online_at=user.online_at,  # noqa
-                        edit_at=user.edit_at,  # noqa
-                        node_usages=user_node_usages,  # noqa
-                    )
-                )
-            del users
+def iter_marzban_data(
+    ms: Session,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    subscription_url_prefix: str,
+    progress: _TrackThread,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    rollup: Optional[UsageRollup] = None,
+) -> Iterator[tuple]:
+    """
+    Read the marzban data as (script table name, rows) batches
+    """
+    yield from iter_export_info(rollup)
+    yield from iter_marzban_admins(ms, subscription_url_prefix, progress)
+    yield from iter_marzban_users(
+        ms,
+        transform_protocol,
+        non_uuid_handling,
+        progress,
+        batch_size,
+        usages_batch_size,
+        rollup=rollup,
+    )
+    yield from iter_marzban_usages(ms, progress, usages_batch_size, rollup)
 
-            ss.add(
-                script.Admin(
-                    username=admin.username,  # noqa
-                    hashed_password=admin.hashed_password,  # noqa
-                    is_sudo=admin.is_sudo,  # noqa
-                    password_reset_at=admin.password_reset_at,  # noqa
-                    subscription_url_prefix=subscription_url_prefix,  # noqa
-                    created_at=admin.created_at,  # noqa
-                    users=admin_users,  # noqa
-                )
+
+def write_script_rows(ss: Session, batches: Iterable[tuple]) -> None:
+    """
+    Insert the (script table name, rows) batches to the script database, committing each batch
+    """
+    import script_models as script
+
+    for table_name, rows in batches:
+        ss.execute(insert(script.Base.metadata.tables[table_name]), rows)
+        ss.commit()
+        del rows
+
+
+def iter_export_info(rollup: Optional[UsageRollup] = None) -> Iterator[tuple]:
+    """
+    Get the export start time as a script database row, the next imports continue from it
+    """
+    # marzban keeps its times in utc, the time is taken before anything is read
+    yield "export_info", [
+        dict(
+            exported_at=datetime.utcnow(),  # noqa
+            rolled_up_before=rollup.before if rollup else None,
+        )
+    ]
+
+
+def iter_marzban_admins(
+    ms: Session, subscription_url_prefix: str, progress: _TrackThread
+) -> Iterator[tuple]:
+    """
+    Read the marzban admins as script database rows
+    """
+    import marzban_models as marzban
+
+    QUERY_STATS.start_phase("admins")
+    admins = ms.query(marzban.Admin).order_by(marzban.Admin.id).all()
+    progress.completed += len(admins)
+    if admins:
+        yield "admins", [
+            dict(
+                id=admin.id,
+                username=admin.username,
+                hashed_password=admin.hashed_password,
+                is_sudo=admin.is_sudo,
+                password_reset_at=admin.password_reset_at,
+                subscription_url_prefix=subscription_url_prefix,
+                created_at=admin.created_at,
             )
-        del admins
+            for admin in admins
+        ]
+    del admins
 
-        node_usages = ms.query(marzban.NodeUsage)
-        for node_usage in node_usages:
-            progress.completed += 1
 
-            ss.add(
-                script.NodeUsage(
-                    created_at=node_usage.created_at,  # noqa
-                    uplink=node_usage.uplink,  # noqa
-                    downlink=node_usage.downlink,  # noqa
-                )
+def iter_marzban_usages(
+    ms: Session,
+    progress: _TrackThread,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    rollup: Optional[UsageRollup] = None,
+) -> Iterator[tuple]:
+    """
+    Read the marzban node usages, system traffic and jwt secret key as script database rows
+    """
+    import marzban_models as marzban
+
+    QUERY_STATS.start_phase("node usages")
+    criteria = []
+    if rollup:
+        criteria.append(marzban.NodeUsage.created_at >= rollup.before)
+
+        # the periods of all nodes are few, they are read at once
+        bucket = rollup.bucket(ms, marzban.NodeUsage.created_at)
+        node_usages = (
+            ms.query(
+                bucket,
+                func.sum(marzban.NodeUsage.uplink),
+                func.sum(marzban.NodeUsage.downlink),
+                func.count(),
             )
+            .filter(marzban.NodeUsage.created_at < rollup.before)
+            .group_by(bucket)
+            .order_by(bucket)
+            .all()
+        )
+        if node_usages:
+            rollup.add(sum(count for *_, count in node_usages), len(node_usages))
+            progress.completed += sum(count for *_, count in node_usages)
+            yield "node_usages", [
+                dict(
+                    created_at=rollup.bucket_datetime(created_at),
+                    uplink=int(uplink or 0),
+                    downlink=int(downlink or 0),
+                )
+                for created_at, uplink, downlink, _ in node_usages
+            ]
         del node_usages
 
-        marzban_system = ms.query(marzban.System).first()
-        progress.completed += 1
-        if marzban_system:
-            ss.add(
-                script.System(
-                    uplink=marzban_system.uplink,  # noqa
-                    downlink=marzban_system.downlink,  # noqa
+    for node_usages in iter_keyset_pages(
+        ms,
+        marzban.NodeUsage,
+        usages_batch_size,
+        *criteria,
+        columns=(
+            marzban.NodeUsage.id,
+            marzban.NodeUsage.created_at,
+            marzban.NodeUsage.uplink,
+            marzban.NodeUsage.downlink,
+        ),
+    ):
+        progress.completed += len(node_usages)
+        yield "node_usages", [
+            dict(created_at=created_at, uplink=uplink, downlink=downlink)
+            for _, created_at, uplink, downlink in node_usages
+        ]
+        del node_usages
+
+    QUERY_STATS.start_phase("system")
+    marzban_system = ms.query(marzban.System).first()
+    progress.completed += 1
+    if marzban_system:
+        yield "system", [
+            dict(uplink=marzban_system.uplink, downlink=marzban_system.downlink)
+        ]
+    del marzban_system
+
+    QUERY_STATS.start_phase("jwt")
+    jwt_token = ms.query(marzban.JWT.secret_key).scalar()
+    progress.completed += 1
+    if jwt_token:
+        yield "jwt", [dict(secret_key=jwt_token)]
+    del jwt_token
+
+
+def export_marzban_users(
+    ms: Session,
+    ss: Session,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    progress: _TrackThread,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    first_user_id: Optional[int] = None,
+    last_user_id: Optional[int] = None,
+    rollup: Optional[UsageRollup] = None,
+) -> None:
+    """
+    Export the users and their node usages, optionally of an id range only
+    """
+    write_script_rows(
+        ss,
+        iter_marzban_users(
+            ms,
+            transform_protocol,
+            non_uuid_handling,
+            progress,
+            batch_size,
+            usages_batch_size,
+            first_user_id,
+            last_user_id,
+            rollup,
+        ),
+    )
+
+
+def iter_marzban_users(
+    ms: Session,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    progress: _TrackThread,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    first_user_id: Optional[int] = None,
+    last_user_id: Optional[int] = None,
+    rollup: Optional[UsageRollup] = None,
+) -> Iterator[tuple]:
+    """
+    Read the users and their node usages as script database rows, optionally of an id range only
+    """
+    import marzban_models as marzban
+    import script_models as script
+
+    QUERY_STATS.start_phase("users")
+    tehran_tz = timezone("Asia/Tehran")
+
+    users_criteria = [marzban.User.admin_id.isnot(None)]
+    user_node_usages_criteria = []
+    if first_user_id is not None and last_user_id is not None:
+        users_criteria.append(marzban.User.id.between(first_user_id, last_user_id))
+        user_node_usages_criteria.append(
+            marzban.NodeUserUsage.user_id.between(first_user_id, last_user_id)
+        )
+
+    # users are read page by page and their proxies are read once per page and
+    # joined in memory by user id, every page is written before the next one
+    exported_user_ids = set()
+    for users in iter_keyset_pages(ms, marzban.User, batch_size, *users_criteria):
+        first_page_user_id, last_page_user_id = users[0].id, users[-1].id
+
+        users_proxies = defaultdict(dict)
+        proxies = ms.query(
+            marzban.Proxy.user_id, marzban.Proxy.type, marzban.Proxy.settings
+        ).filter(
+            marzban.Proxy.user_id.between(first_page_user_id, last_page_user_id),
+            marzban.Proxy.type.in_(
+                (marzban.ProxyTypes.VLESS, marzban.ProxyTypes.VMess)
+            ),
+        )
+        for user_id, proxy_type, proxy_settings in proxies:
+            users_proxies[user_id][proxy_type.value] = proxy_settings
+        del proxies
+
+        # lifetime used traffic of the page users in one aggregated query
+        # instead of lazy loading the usage logs of every user
+        users_reset_traffic = {
+            user_id: int(reset_traffic)
+            for user_id, reset_traffic in ms.query(
+                marzban.UserUsageResetLogs.user_id,
+                func.sum(marzban.UserUsageResetLogs.used_traffic_at_reset),
+            )
+            .filter(
+                marzban.UserUsageResetLogs.user_id.between(
+                    first_page_user_id, last_page_user_id
                 )
             )
-        del marzban_system
+            .group_by(marzban.UserUsageResetLogs.user_id)
+        }
 
-        jwt_token = ms.query(marzban.JWT.secret_key).scalar()
-        progress.completed += 1
-        if jwt_token:
-            ss.add(
-                script.JWT(
-                    secret_key=jwt_token,  # noqa
+        user_rows = []
+        for user in users:
+            progress.completed += 1
+
+            key = user_key(users_proxies.get(user.id, {}), transform_protocol)  # noqa
+            if not key:
+                if non_uuid_handling == "skip":
+                    continue
+                key = token_hex(16)
+
+            data_limit = user.data_limit or 0
+            used_traffic = user.used_traffic or 0
+            used_traffic = min(data_limit, used_traffic) if data_limit != 0 else used_traffic
+            usage_duration = 0
+            activation_deadline = None
+            expire_date = None
+            if user.status == marzban.UserStatus.on_hold:
+                expire_strategy = script.UserExpireStrategy.START_ON_FIRST_USE
+                usage_duration = user.on_hold_expire_duration
+                activation_deadline = user.on_hold_timeout
+
+            elif not (user.expire is None):
+                expire_strategy = script.UserExpireStrategy.FIXED_DATE
+                expire_date = datetime.fromtimestamp(
+                    user.expire, tz=datetime_timezone.utc  # noqa
+                ).astimezone(tehran_tz)
+            else:
+                expire_strategy = script.UserExpireStrategy.NEVER
+
+            user_rows.append(
+                dict(
+                    id=user.id,
+                    admin_id=user.admin_id,
+                    username=user.username,
+                    key=key,
+                    enabled=not user.status == marzban.UserStatus.disabled,
+                    expire_strategy=expire_strategy,
+                    expire_date=expire_date,
+                    usage_duration=usage_duration,
+                    activation_deadline=activation_deadline,
+                    data_limit=data_limit,
+                    data_limit_reset_strategy=user.data_limit_reset_strategy,
+                    note=user.note,
+                    used_traffic=used_traffic,
+                    lifetime_used_traffic=(
+                        users_reset_traffic.get(user.id, 0) + (user.used_traffic or 0)
+                    ),
+                    sub_updated_at=user.sub_updated_at,
+                    sub_revoked_at=user.sub_revoked_at,
+                    sub_last_user_agent=user.sub_last_user_agent,
+                    created_at=user.created_at,
+                    online_at=user.online_at,
+                    edit_at=user.edit_at,
                 )
             )
-        del jwt_token
+            exported_user_ids.add(user.id)
+        del users, users_proxies, users_reset_traffic
+
+        if user_rows:
+            yield "users", user_rows
+        del user_rows
+
+    # node usages are streamed in pages of their own, so the memory usage does
+    # not depend on the usages count of the users
+    QUERY_STATS.start_phase("node usages")
+    if rollup:
+        yield from iter_marzban_rolled_up_user_usages(
+            ms, sorted(exported_user_ids), progress, batch_size, rollup
+        )
+        user_node_usages_criteria.append(marzban.NodeUserUsage.created_at >= rollup.before)
+
+    for user_node_usages in iter_keyset_pages(
+        ms,
+        marzban.NodeUserUsage,
+        usages_batch_size,
+        *user_node_usages_criteria,
+        columns=(
+            marzban.NodeUserUsage.id,
+            marzban.NodeUserUsage.user_id,
+            marzban.NodeUserUsage.created_at,
+            marzban.NodeUserUsage.used_traffic,
+        ),
+    ):
+        user_node_usage_rows = [
+            dict(user_id=user_id, created_at=created_at, used_traffic=used_traffic)
+            for _, user_id, created_at, used_traffic in user_node_usages
+            if user_id in exported_user_ids
+        ]
+        progress.completed += len(user_node_usages)
+        del user_node_usages
+
+        if user_node_usage_rows:
+            yield "node_user_usages", user_node_usage_rows
+        del user_node_usage_rows
+    del exported_user_ids
+
+
+def iter_marzban_rolled_up_user_usages(
+    ms: Session,
+    user_ids: list,
+    progress: _TrackThread,
+    batch_size: int,
+    rollup: UsageRollup,
+) -> Iterator[tuple]:
+    """
+    Read the old node usages of the users summed per user and period, a page of users at a time
+    """
+    import marzban_models as marzban
 
-        ss.commit()
+    bucket = rollup.bucket(ms, marzban.NodeUserUsage.created_at)
+    exported_user_ids = set(user_ids)
+    for index in range(0, len(user_ids), batch_size):
+        page_user_ids = user_ids[index:index + batch_size]
+        user_node_usages = (
+            ms.query(
+                marzban.NodeUserUsage.user_id,
+                bucket,
+                func.sum(marzban.NodeUserUsage.used_traffic),
+                func.count(),
+            )
+            .filter(
+                marzban.NodeUserUsage.user_id.between(page_user_ids[0], page_user_ids[-1]),
+                marzban.NodeUserUsage.created_at < rollup.before,
+            )
+            .group_by(marzban.NodeUserUsage.user_id, bucket)
+            .order_by(marzban.NodeUserUsage.user_id, bucket)
+            .all()
+        )
+        rows = 0
+        user_node_usage_rows = []
+        for user_id, created_at, used_traffic, count in user_node_usages:
+            rows += count
+            if user_id in exported_user_ids:
+                rollup.add(count, 1)
+                user_node_usage_rows.append(
+                    dict(
+                        user_id=user_id,
+                        created_at=rollup.bucket_datetime(created_at),
+                        used_traffic=int(used_traffic or 0),
+                    )
+                )
+        progress.completed += rows
+        del user_node_usages
+
+        if user_node_usage_rows:
+            yield "node_user_usages", user_node_usage_rows
+        del user_node_usage_rows
+
+
+def export_marzban_users_shard(
+    db_uri: str,
+    shard_path: str,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    batch_size: int,
+    usages_batch_size: int,
+    first_user_id: int,
+    last_user_id: int,
+    rollup: Optional[UsageRollup] = None,
+) -> tuple:
+    """
+    Export the users of an id range to a shard database, runs in export workers
+    """
+    import script_models as script
 
-    ms.close()
+    shard_engine = create_script_engine(shard_path, True)
+    script.Base.metadata.create_all(
+        shard_engine, tables=[script.User.__table__, script.NodeUserUsage.__table__]
+    )
 
-    print("\n\n")
-    input("Press Enter to continue...")
+    progress = SimpleNamespace(completed=0)
+    if rollup:
+        # the rollup is a copy of the parent one, it counts the usages of the shard only
+        rollup.rows = rollup.buckets = 0
+    with Session(create_database_engine(db_uri), autoflush=False) as ms, Session(
+        shard_engine
+    ) as ss:
+        export_marzban_users(
+            ms,
+            ss,
+            transform_protocol,
+            non_uuid_handling,
+            progress,  # noqa
+            batch_size,
+            usages_batch_size,
+            first_user_id,
+            last_user_id,
+            rollup,
+        )
+    shard_engine.dispose()
+
+    return progress.completed, rollup
+
+
+def export_marzban_users_parallel(
+    ms: Session,
+    ss: Session,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    progress: _TrackThread,
+    workers: int,
+    batch_size: int = EXPORT_BATCH_SIZE,
+    usages_batch_size: int = EXPORT_USAGES_BATCH_SIZE,
+    rollup: Optional[UsageRollup] = None,
+) -> None:
+    """
+    Export the users in worker processes sharded by user id ranges
+    """
+    import marzban_models as marzban
+
+    first_user_id, last_user_id = ms.query(
+        func.min(marzban.User.id), func.max(marzban.User.id)
+    ).one()
+    if first_user_id is None:
+        return
+
+    # more shards than workers, so a dense id range does not hold back the others
+    shards_count = workers * EXPORT_SHARDS_PER_WORKER
+    shard_size = max((last_user_id - first_user_id) // shards_count + 1, 1)
+    shard_ranges = [
+        (start, min(start + shard_size - 1, last_user_id))
+        for start in range(first_user_id, last_user_id + 1, shard_size)
+    ]
+    shard_paths = [
+        f"{ss.get_bind().url.database}.shard{index}"
+        for index in range(len(shard_ranges))
+    ]
+    db_uri = ms.get_bind().url.render_as_string(hide_password=False)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    export_marzban_users_shard,
+                    db_uri,
+                    shard_path,
+                    transform_protocol,
+                    non_uuid_handling,
+                    batch_size,
+                    usages_batch_size,
+                    shard_first_user_id,
+                    shard_last_user_id,
+                    rollup,
+                )
+                for shard_path, (shard_first_user_id, shard_last_user_id) in zip(
+                    shard_paths, shard_ranges
+                )
+            ]
+            for future in as_completed(futures):
+                completed, shard_rollup = future.result()
+                progress.completed += completed
+                if rollup:
+                    rollup.add(shard_rollup.rows, shard_rollup.buckets)
+
+        # the shards are merged in id range order, so the result does not
+        # depend on which worker finished first
+        ss.commit()
+        for shard_path in shard_paths:
+            ss.execute(text("ATTACH DATABASE :path AS shard"), {"path": shard_path})
+            ss.execute(
+                text("INSERT INTO main.users SELECT * FROM shard.users ORDER BY id")
+            )
+            ss.execute(
+                text(
+                    "INSERT INTO main.node_user_usages (created_at, user_id, used_traffic) "
+                    "SELECT created_at, user_id, used_traffic "
+                    "FROM shard.node_user_usages ORDER BY id"
+                )
+            )
+            ss.commit()
+            ss.execute(text("DETACH DATABASE shard"))
+    finally:
+        for shard_path in shard_paths:
+            if exists(shard_path):
+                remove(shard_path)
 
 
 def marzneshin_importer() -> None:
     """
     Import data to marzneshin
     """
-    import marzneshin_models as marzneshin
     import script_models as script
 
     clear()
@@ -625,8 +2202,62 @@ def marzneshin_importer() -> None:
     check_marzneshin_requirements()
 
     # get the database path
-    db_path = get_file_path("Marzban Datastore", SCRIPT_DB_PATH, check_sqlite_file)
+    db_path = open_datastore(
+        get_file_path("Marzban Datastore", default_datastore_path(), check_datastore_file)
+    )
+
+    db_uri = get_marzneshin_db_uri()
+    ms, ss, first_node_id, inbounds = open_import_sessions(db_uri, db_path)
+
+    checkpoint = load_import_checkpoint(ms, ss, md5(db_uri.encode()).hexdigest())
+    if checkpoint.stage == script.ImportStage.done:
+        clear()
+        warning("This datastore is already imported to this Marzneshin")
+        if selector("Should it be imported again?", "no", "yes") == "no":
+            return
+        reset_import_checkpoint(ss, checkpoint)
+
+    if checkpoint.admin_id or checkpoint.stage != script.ImportStage.users:
+        clear()
+        info("The previous import is not finished, it will be continued from the last checkpoint")
+        exists_admins_handling = checkpoint.exists_admins_handling
+        exists_users_handling = checkpoint.exists_users_handling
+        input("Press Enter to continue...")
+    else:
+        exists_admins_handling, exists_users_handling = ask_import_options()
+
+        checkpoint.exists_admins_handling = exists_admins_handling
+        checkpoint.exists_users_handling = exists_users_handling
+        checkpoint.incremental = ask_incremental(
+            ms, marzban_panel_id(ss.query(script.JWT.secret_key).scalar())
+        )
+        ss.commit()
+
+    clear()
 
+    valid = import_marzneshin(
+        ms,
+        ss,
+        first_node_id,
+        inbounds,
+        exists_admins_handling,
+        exists_users_handling,
+        checkpoint,
+    )
+    enable_source_updater()
+    if not valid:
+        error("Some imported rows refer to missing rows, check the marzneshin database")
+
+    print("\n\n")
+    save_query_stats()
+    input("Press Enter to continue...")
+
+
+def ask_import_options() -> tuple:
+    """
+    Ask how the existing admins and users of marzneshin should be handled
+    """
+    clear()
     # marzneshin is new(empty) or old(has admin or user)
     marzneshin_status = selector(
         "Is Marzneshin new(no admin and user) or old(has admin or user)?",
@@ -669,7 +2300,30 @@ def marzneshin_importer() -> None:
             "skip",
         )
 
-    # get marzneshin database uri
+    return exists_admins_handling, exists_users_handling
+
+
+def ask_incremental(ms: Session, panel_id: str) -> bool:
+    """
+    Ask whether only the changes since the last import of the marzban should be imported
+    """
+    state = get_marzban_sync(ms, panel_id)
+    if state is None:
+        return False
+
+    clear()
+    warning(
+        f"This Marzban is imported before, from a datastore of {state.exported_at:%Y-%m-%d %H:%M}."
+        f"\nchanges: Import the new and changed data since then."
+        f"\neverything: Import all data, the usages and traffic are added again."
+    )
+    return selector("What should be imported?", "changes", "everything") == "changes"
+
+
+def get_marzneshin_db_uri() -> str:
+    """
+    Get the database uri of marzneshin from its docker compose or .env file
+    """
     with open(MARZNESHIN_DOCKER_COMPOSE_PATH, encoding="utf-8") as file:
         environment = safe_load(file)
     for key in MARZNESHIN_DOCKER_COMPOSE_ENV_PATH:
@@ -685,8 +2339,31 @@ def marzneshin_importer() -> None:
             error("Database URI not found in .env file", True)
         del repository
 
-    ms = Session(create_engine(db_uri), autoflush=False)
-    ss = Session(create_engine(f"sqlite:///{db_path}"))
+    return db_uri
+
+
+def open_import_sessions(db_uri: str, db_path: str) -> tuple:
+    """
+    Open the marzneshin and script database sessions and get the node and inbounds to import to
+    """
+    QUERY_STATS.reset()
+    ms = Session(create_database_engine(db_uri, True), autoflush=False)
+    QUERY_STATS.attach(ms.get_bind(), "marzneshin")
+    ss = Session(create_script_engine(db_path))
+    QUERY_STATS.attach(ss.get_bind(), "script")
+
+    # the datastores of the older exporters have no indexes
+    create_script_indexes(ss)
+    ss.commit()
+
+    return ms, ss, *get_import_target(ms)
+
+
+def get_import_target(ms: Session) -> tuple:
+    """
+    Get the first node and the inbounds of marzneshin, the users are imported to them
+    """
+    import marzneshin_models as marzneshin
 
     first_node_id = ms.query(marzneshin.Node.id).first()
     if first_node_id is None:
@@ -698,31 +2375,243 @@ def marzneshin_importer() -> None:
     if not inbounds:
         error("There is no inbound in Marzneshin", True)
 
-    get_admin = exists_checker_generator(ms, marzneshin.Admin, True)
-    get_user = exists_checker_generator(ms, marzneshin.User, True)
-    get_user_node_usage = exists_checker_generator(ms, marzneshin.NodeUserUsage, True)
-    get_node_usage = exists_checker_generator(ms, marzneshin.NodeUsage, True)
-    check_admin_exists = exists_checker_generator(ms, marzneshin.Admin)
-    check_user_exists = exists_checker_generator(ms, marzneshin.User)
-    check_service_exists = exists_checker_generator(
-        ms, marzneshin.Service, main_key="name"
+    return first_node_id, inbounds
+
+
+def import_marzneshin(
+    ms: Session,
+    ss: Session,
+    first_node_id: int,
+    inbounds: list,
+    exists_admins_handling: str,
+    exists_users_handling: str,
+    checkpoint,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    usages_batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+    save_jwt_token: bool = True,
+) -> bool:
+    """
+    Import the script database to marzneshin and keep its jwt token for the subscriptions
+    """
+    import script_models as script
+
+    marzban_jwt_token = ss.query(script.JWT.secret_key).scalar()
+
+    sync = SyncWindow(ms, ss, marzban_panel_id(marzban_jwt_token), checkpoint.incremental)
+    with create_progress_bar("Importing users", total := get_total(ss, script)) as progress:
+        valid = import_script_data(
+            ms,
+            ss,
+            first_node_id,
+            inbounds,
+            exists_admins_handling,
+            exists_users_handling,
+            progress,
+            checkpoint,
+            sync,
+            batch_size,
+            usages_batch_size,
+        )
+
+        QUERY_STATS.start_phase("jwt")
+        if save_jwt_token:
+            save_marzban_jwt_token(marzban_jwt_token)
+        progress.completed += 1
+
+        progress.completed = total
+
+    ms.close()
+    ss.close()
+    return valid
+
+
+def save_marzban_jwt_token(marzban_jwt_token: str) -> None:
+    """
+    Add the marzban jwt secret key to the tokens of the subscription source updater
+    """
+    if not exists(JWT_FILE_PATH):
+        if not exists(SCRIPTS_DIR):
+            mkdir(SCRIPTS_DIR)
+        if not exists(CONFIG_DIR):
+            mkdir(CONFIGS_DIR)
+        if not exists(CONFIG_DIR):
+            mkdir(CONFIG_DIR)
+        tokens = set()
+    else:
+        try:
+            with open(JWT_FILE_PATH) as f:
+                tokens = set(f.read().splitlines())
+        except:  # noqa
+            tokens = set()
+
+    tokens.add(marzban_jwt_token)
+    with open(JWT_FILE_PATH, "w") as f:
+        f.write("\n".join(tokens))
+
+
+def enable_source_updater() -> None:
+    """
+    Install and restart the service that adds the marzban subscriptions to marzneshin
+    """
+    with open(SOURCE_UPDATER_SYSTEMD_PATH, "w") as f:
+        f.write(SOURCE_UPDATER_SYSTEMD_CONTENT)
+
+    os_system(
+        f"systemctl daemon-reload; systemctl enable {REPO_NAME}; systemctl restart {REPO_NAME}"
     )
 
-    clear()
 
+def import_script_data(
+    ms: Session,
+    ss: Session,
+    first_node_id: int,
+    inbounds: list,
+    exists_admins_handling: str,
+    exists_users_handling: str,
+    progress: _TrackThread,
+    checkpoint,
+    sync: SyncWindow,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    usages_batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+) -> bool:
+    """
+    Import the script database data to marzneshin in chunks, continuing from the checkpoint
+    """
+    import script_models as script
+
+    valid = True
+    if checkpoint.stage == script.ImportStage.users:
+        import_script_users(
+            ms,
+            ss,
+            inbounds,
+            exists_admins_handling,
+            exists_users_handling,
+            progress,
+            checkpoint,
+            sync,
+            batch_size,
+        )
+        checkpoint.stage = script.ImportStage.user_node_usages.value
+        checkpoint.usage_id = 0
+        ss.commit()
 
-    with create_progress_bar("Importing users", total := get_total(ss, script)) as progress:
-        admins = ss.query(script.Admin)
-        for admin in admins:
-            progress.completed += 1
+    if checkpoint.stage == script.ImportStage.user_node_usages:
+        import_script_user_node_usages(
+            ms, ss, first_node_id, progress, checkpoint, sync, usages_batch_size
+        )
+        checkpoint.stage = script.ImportStage.node_usages.value
+        checkpoint.usage_id = 0
+        ss.commit()
+
+    if checkpoint.stage == script.ImportStage.node_usages:
+        import_script_node_usages(
+            ms, ss, first_node_id, progress, checkpoint, sync, usages_batch_size
+        )
+        checkpoint.stage = script.ImportStage.system.value
+        checkpoint.usage_id = 0
+        ss.commit()
 
+    if checkpoint.stage == script.ImportStage.system:
+        import_script_system(ms, ss, checkpoint, sync, first_node_id)
+        valid = check_foreign_keys(ms)
+    progress.completed += 1
+    return valid
+
+
+def import_script_users(
+    ms: Session,
+    ss: Session,
+    inbounds: list,
+    exists_admins_handling: str,
+    exists_users_handling: str,
+    progress: _TrackThread,
+    checkpoint,
+    sync: SyncWindow,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> None:
+    """
+    Import the admins and users of the script database, committing each page of users
+    """
+    import marzneshin_models as marzneshin
+    import script_models as script
+
+    users_table = marzneshin.User.__table__
+    users_services_table = marzneshin.users_services
+    marzban_users_table = marzneshin.MarzbanUser.__table__
+
+    marzban_users_table.create(ms.connection(), checkfirst=True)
+    ms.commit()
+    marzban_users_statement = upsert_statement(
+        ms, marzban_users_table, ("panel", "username"), ("user_id",)
+    )
+    marzban_admins_statement = upsert_statement(
+        ms, marzneshin.MarzbanAdmin.__table__, ("panel", "username"), ("admin_id",)
+    )
+
+    # the admins and users of the last imports of the panel are updated in place
+    synced_admins = sync.synced(ms, marzneshin.MarzbanAdmin.admin_id, marzneshin.Admin.id)
+    synced_users = sync.synced(ms, marzneshin.MarzbanUser.user_id, marzneshin.User.id)
+    if synced_users:
+        import_synced_users(ss, checkpoint, synced_users, batch_size)
+        synced_user_keys = dict(
+            ms.query(marzneshin.User.id, marzneshin.User.key)
+            .join(marzneshin.MarzbanUser, marzneshin.MarzbanUser.user_id == marzneshin.User.id)
+            .filter(marzneshin.MarzbanUser.panel == sync.panel_id)
+        )
+    else:
+        synced_user_keys = {}
+
+    # existence checks and renaming are done on indexes loaded once
+    admins_index = ExistsIndex(ms, marzneshin.Admin.username, marzneshin.Admin.id)
+    users_index = ExistsIndex(ms, marzneshin.User.username, marzneshin.User.id)
+    keys_index = ExistsIndex(ms, marzneshin.User.key, marzneshin.User.id)
+    services_index = ExistsIndex(ms, marzneshin.Service.name)
+
+    admins = (
+        ss.query(script.Admin)
+        .filter(script.Admin.id >= checkpoint.admin_id)
+        .order_by(script.Admin.id)
+        .all()
+    )
+    for admin in admins:
+        progress.completed += 1
+
+        QUERY_STATS.start_phase("admins")
+        if admin.id == checkpoint.admin_id and checkpoint.marzneshin_admin_id:
+            # the admin is imported before, continue importing its users
+            new_admin = ms.get(marzneshin.Admin, checkpoint.marzneshin_admin_id)
+            services = new_admin.services
+            last_user_id = checkpoint.user_id
+        elif synced_admin_id := synced_admins.get(admin.username):
+            # the admin is imported before, its users are not replaced
+            new_admin = ms.get(marzneshin.Admin, synced_admin_id)
+            new_admin.hashed_password = admin.hashed_password
+            new_admin.all_services_access = admin.is_sudo
+            new_admin.is_sudo = admin.is_sudo
+            new_admin.password_reset_at = admin.password_reset_at
+            new_admin.subscription_url_prefix = admin.subscription_url_prefix
+            services = new_admin.services
+
+            commit_import_chunk(
+                ms,
+                ss,
+                checkpoint,
+                None,  # updating the admin again changes nothing
+                admin_id=admin.id,
+                marzneshin_admin_id=new_admin.id,
+                user_id=0,
+            )
+            last_user_id = 0
+        else:
             admin_username = admin.username
-            if exists_admin := get_admin(admin.username):  # noqa
+            if exists_admin_id := admins_index.get(admin.username):
                 if exists_admins_handling == "skip":
                     continue
+                exists_admin = ms.get(marzneshin.Admin, exists_admin_id)
                 if exists_admins_handling == "rename":
                     new_username = increasing_number_username(
-                        admin.username, check_admin_exists  # noqa
+                        admin.username, admins_index  # noqa
                     )
                     if new_username is None:
                         warning(f"Cannot rename the admin({admin.username})")
@@ -730,18 +2619,19 @@ def marzneshin_importer() -> None:
                     admin_username = new_username
                 services = exists_admin.services
             else:
+                exists_admin = None
                 service_name = f"{admin_username}_service"
                 if len(service_name) >= 64:
                     service_name = admin_username[:60]
-                if check_service_exists(service_name):
+                if services_index(service_name):
                     service_name = increasing_number_username(
-                        service_name, check_service_exists, 64
+                        service_name, services_index, 64
                     )
                     if service_name is None:
                         warning(
                             "Can't create service that name contains admin username, generating random one"
                         )
-                        service_name = random_name_generator(check_service_exists, 64)
+                        service_name = random_name_generator(services_index, 64)
                         if service_name is None:
                             error(
                                 f"Can't create service for admin({admin.username}), we will skip it"
@@ -751,204 +2641,1164 @@ def marzneshin_importer() -> None:
                 services = [
                     marzneshin.Service(name=service_name, inbounds=inbounds)  # noqa
                 ]
+                services_index.add(service_name)
 
-            users = ss.query(script.User).filter_by(admin_id=admin.id)
-            admin_users = []
+            if exists_admin and exists_admins_handling == "update":
+                exists_admin.hashed_password = admin.hashed_password
+                exists_admin.services = services
+                exists_admin.all_services_access = admin.is_sudo
+                exists_admin.created_at = admin.created_at
+                exists_admin.is_sudo = admin.is_sudo
+                exists_admin.password_reset_at = admin.password_reset_at
+                exists_admin.subscription_url_prefix = admin.subscription_url_prefix
+                new_admin = exists_admin
+            else:
+                new_admin = marzneshin.Admin(
+                    username=admin_username,
+                    hashed_password=admin.hashed_password,
+                    services=services,  # noqa
+                    all_services_access=admin.is_sudo,
+                    created_at=admin.created_at,
+                    is_sudo=admin.is_sudo,
+                    password_reset_at=admin.password_reset_at,
+                    subscription_url_prefix=admin.subscription_url_prefix,
+                )
+                ms.add(new_admin)
+            ms.flush()
+            admins_index.add(admin_username, new_admin.id)
+
+            if new_admin is exists_admin:
+                # the imported users replace the current users of the admin
+                ms.execute(
+                    update(users_table)
+                    .where(users_table.c.admin_id == new_admin.id)
+                    .values(admin_id=None)
+                )
+                probe = None  # updating the admin again changes nothing
+            else:
+                probe = dict(table="admins", id=new_admin.id, columns=[], value=None)
+            ms.execute(
+                marzban_admins_statement,
+                [dict(panel=sync.panel_id, username=admin.username, admin_id=new_admin.id)],
+            )
+
+            commit_import_chunk(
+                ms,
+                ss,
+                checkpoint,
+                probe,
+                admin_id=admin.id,
+                marzneshin_admin_id=new_admin.id,
+                user_id=0,
+            )
+            last_user_id = 0
+
+        service_ids = [service.id for service in services]
+
+        QUERY_STATS.start_phase("users")
+        for users in iter_keyset_pages(
+            ss,
+            script.User,
+            batch_size,
+            script.User.admin_id == admin.id,
+            *sync.users_criteria(),
+            after_id=last_user_id,
+        ):
+            new_users = {}
+            updated_users = {}
+            marzneshin_user_ids = {}
+            marzban_users = {}
             for user in users:
                 progress.completed += 1
 
-                user_username = sub(r"\W", "", user.username.lower())
-                if exists_user := get_user(user_username):  # noqa
+                user_username = marzban_username = sub(r"\W", "", user.username.lower())
+                staged_user = new_users.get(user_username) or updated_users.get(
+                    user_username
+                )
+                key = user.key
+                exists_user_id = synced_users.get(marzban_username)
+                if exists_user_id:
+                    updating = True
+                    # the users without uuid get a new key in every export, the
+                    # key changes only if the subscription is revoked since then
+                    if user.sub_revoked_at is None or user.sub_revoked_at < sync.since:
+                        key = synced_user_keys.get(exists_user_id) or key
+                elif exists_user_id := users_index.get(user_username):
+                    updating = exists_users_handling == "update"
                     if exists_users_handling == "skip":
                         continue
                     if exists_users_handling == "rename":
                         new_username = hash_based_username(
-                            user_username, check_user_exists  # noqa
+                            user_username, users_index  # noqa
                         )
                         if new_username is None:
                             warning(f"Cannot rename the user({user_username}")
                             continue
                         user_username = new_username
-
-                if exists_user and exists_users_handling == "update":
-                    exists_user.key = user.key
-                    exists_user.enabled = user.enabled
-                    exists_user.services = services
-                    exists_user.used_traffic = user.used_traffic
-                    exists_user.lifetime_used_traffic = user.lifetime_used_traffic
-                    exists_user.data_limit = user.data_limit
-                    exists_user.data_limit_reset_strategy = (
-                        user.data_limit_reset_strategy
-                    )
-                    exists_user.expire_strategy = user.expire_strategy
-                    exists_user.expire_date = user.expire_date
-                    exists_user.usage_duration = user.usage_duration
-                    exists_user.activation_deadline = user.activation_deadline
-                    exists_user.sub_updated_at = user.sub_updated_at
-                    exists_user.sub_revoked_at = user.sub_revoked_at
-                    exists_user.sub_last_user_agent = user.sub_last_user_agent
-                    exists_user.created_at = user.created_at
-                    exists_user.online_at = user.online_at
-                    exists_user.edit_at = user.edit_at
-                    exists_user.note = user.note
-                    new_user = exists_user
                 else:
-                    new_user = marzneshin.User(
-                        username=user_username,
-                        key=user.key,
-                        enabled=user.enabled,
-                        services=services,  # noqa
-                        used_traffic=user.used_traffic,
-                        lifetime_used_traffic=user.lifetime_used_traffic,
-                        data_limit=user.data_limit,
-                        data_limit_reset_strategy=user.data_limit_reset_strategy,
-                        expire_strategy=user.expire_strategy,
-                        expire_date=user.expire_date,
-                        usage_duration=user.usage_duration,
-                        activation_deadline=user.activation_deadline,
-                        sub_updated_at=user.sub_updated_at,
-                        sub_revoked_at=user.sub_revoked_at,
-                        sub_last_user_agent=user.sub_last_user_agent,
-                        created_at=user.created_at,
-                        online_at=user.online_at,
-                        edit_at=user.edit_at,
-                        note=user.note,
-                    )
-                    ms.add(new_user)
-                    ms.flush()
-                    ms.refresh(new_user)
-
-                admin_users.append(new_user)
-
-                user_node_usages = ss.query(script.NodeUserUsage).filter_by(
-                    user_id=user.id
+                    updating = False
+
+                user_row = dict(
+                    key=key,
+                    enabled=user.enabled,
+                    admin_id=new_admin.id,
+                    used_traffic=user.used_traffic,
+                    lifetime_used_traffic=user.lifetime_used_traffic,
+                    data_limit=user.data_limit,
+                    data_limit_reset_strategy=user.data_limit_reset_strategy,
+                    expire_strategy=user.expire_strategy,
+                    expire_date=user.expire_date,
+                    usage_duration=user.usage_duration,
+                    activation_deadline=user.activation_deadline,
+                    sub_updated_at=user.sub_updated_at,
+                    sub_revoked_at=user.sub_revoked_at,
+                    sub_last_user_agent=user.sub_last_user_agent,
+                    created_at=user.created_at,
+                    online_at=user.online_at,
+                    edit_at=user.edit_at,
+                    note=user.note,
                 )
-                for user_node_usage in user_node_usages:
-                    progress.completed += 1
-
-                    exists_node_user_usage = get_user_node_usage(
-                        user_id=new_user.id,
-                        created_at=user_node_usage.created_at,
-                        node_id=first_node_id,
-                    )
-                    if exists_node_user_usage:
-                        exists_node_user_usage.used_traffic += (
-                            user_node_usage.used_traffic
-                        )
+                key_user_id = keys_index.get(key)
+                if key_user_id and not (updating and key_user_id == exists_user_id):
+                    warning(f"The key of the user({user_username}) is already used, revoking it")
+                    user_row["key"] = token_hex(16)
+
+                if updating:
+                    if staged_user:
+                        staged_user.update(user_row)
                     else:
-                        ms.add(
-                            marzneshin.NodeUserUsage(
-                                user_id=new_user.id,
-                                created_at=user_node_usage.created_at,  # noqa
-                                used_traffic=user_node_usage.used_traffic,  # noqa
-                                node_id=first_node_id,  # noqa
-                            )
+                        updated_users[user_username] = dict(
+                            id=exists_user_id, **user_row
                         )
-                    ms.flush()
-                del user_node_usages
+                    marzneshin_user_ids[user.id] = exists_user_id
+                    marzban_users[marzban_username] = exists_user_id
+                    keys_index.add(user_row["key"], exists_user_id)
+                else:
+                    # the new users are referred by their usernames until the
+                    # database gives them ids when the chunk is inserted
+                    new_users[user_username] = dict(username=user_username, **user_row)
+                    marzneshin_user_ids[user.id] = user_username
+                    marzban_users[marzban_username] = user_username
+                    users_index.add(user_username, user_username)
+                    keys_index.add(user_row["key"], user_username)
+            last_user_id = users[-1].id
             del users
 
-            if exists_admin and exists_admins_handling == "update":
-                exists_admin.hashed_password = admin.hashed_password
-                exists_admin.users = admin_users
-                exists_admin.services = services
-                exists_admin.all_services_access = admin.is_sudo
-                exists_admin.created_at = admin.created_at
-                exists_admin.is_sudo = admin.is_sudo
-                exists_admin.password_reset_at = admin.password_reset_at
-                exists_admin.subscription_url_prefix = admin.subscription_url_prefix
+            if new_users:
+                new_user_ids = insert_returning_ids(
+                    ms, users_table, list(new_users.values()), "username"
+                )
+                for username, user_id in new_user_ids.items():
+                    users_index.add(username, user_id)
+                    keys_index.add(new_users[username]["key"], user_id)
+                marzneshin_user_ids = {
+                    user_id: new_user_ids.get(marzneshin_user_id, marzneshin_user_id)
+                    for user_id, marzneshin_user_id in marzneshin_user_ids.items()
+                }
+                marzban_users = {
+                    username: new_user_ids.get(user_id, user_id)
+                    for username, user_id in marzban_users.items()
+                }
+                probe = dict(
+                    table="users", id=max(new_user_ids.values()), columns=[], value=None
+                )
+                del new_user_ids
             else:
-                ms.add(
-                    marzneshin.Admin(
-                        username=admin_username,
-                        hashed_password=admin.hashed_password,
-                        users=admin_users,  # noqa
-                        services=services,  # noqa
-                        all_services_access=admin.is_sudo,
-                        created_at=admin.created_at,
-                        is_sudo=admin.is_sudo,
-                        password_reset_at=admin.password_reset_at,
-                        subscription_url_prefix=admin.subscription_url_prefix,
+                probe = None  # updating the users again changes nothing
+            if updated_users:
+                ms.execute(
+                    update(users_table).where(users_table.c.id == bindparam("_id")),
+                    [
+                        dict(_id=row["id"], **{k: v for k, v in row.items() if k != "id"})
+                        for row in updated_users.values()
+                    ],
+                )
+                ms.execute(
+                    delete(users_services_table).where(
+                        users_services_table.c.user_id.in_(
+                            [row["id"] for row in updated_users.values()]
+                        )
                     )
                 )
-        del admins, get_admin, get_user
-        del (
-            get_user_node_usage,
-            check_admin_exists,
-            check_user_exists,
-            check_service_exists,
+            if service_ids and marzneshin_user_ids:
+                ms.execute(
+                    insert(users_services_table),
+                    [
+                        dict(user_id=user_id, service_id=service_id)
+                        for user_id in set(marzneshin_user_ids.values())
+                        for service_id in service_ids
+                    ],
+                )
+            if marzban_users:
+                ms.execute(
+                    marzban_users_statement,
+                    [
+                        dict(panel=sync.panel_id, username=username, user_id=user_id)
+                        for username, user_id in marzban_users.items()
+                    ],
+                )
+            del new_users, updated_users, marzban_users
+
+            commit_import_chunk(
+                ms,
+                ss,
+                checkpoint,
+                probe,
+                [
+                    dict(
+                        target=checkpoint.target,
+                        user_id=user_id,
+                        marzneshin_user_id=marzneshin_user_id,
+                    )
+                    for user_id, marzneshin_user_id in marzneshin_user_ids.items()
+                ],
+                user_id=last_user_id,
+            )
+            del marzneshin_user_ids
+    del admins
+    del admins_index, users_index, keys_index, services_index
+
+
+def import_synced_users(
+    ss: Session, checkpoint, synced_users: dict, batch_size: int = IMPORT_BATCH_SIZE
+) -> None:
+    """
+    Map the users that are imported before to their marzneshin users, so their new usages are imported even if they are not changed
+    """
+    import script_models as script
+
+    statement = sqlite_insert(script.ImportedUser.__table__).on_conflict_do_nothing()
+    for users in iter_keyset_pages(
+        ss, script.User, batch_size, columns=(script.User.id, script.User.username)
+    ):
+        imported_users = [
+            dict(target=checkpoint.target, user_id=user.id, marzneshin_user_id=user_id)
+            for user in users
+            if (user_id := synced_users.get(sub(r"\W", "", user.username.lower())))
+        ]
+        if imported_users:
+            ss.execute(statement, imported_users)
+        ss.commit()
+        del users, imported_users
+
+
+def import_script_usages(
+    ms: Session,
+    ss: Session,
+    model,
+    columns: tuple,
+    criteria: tuple,
+    values: dict,
+    index_elements: tuple,
+    sum_columns: tuple,
+    progress: _TrackThread,
+    checkpoint,
+    batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+) -> None:
+    """
+    Merge the usages of the script database into marzneshin, committing each page
+    """
+    import marzneshin_models as marzneshin
+
+    QUERY_STATS.start_phase("node usages")
+    table = marzneshin.Base.metadata.tables[model.__tablename__]
+    async_urls = [async_engine_url(session.get_bind().url) for session in (ms, ss)]
+    if all(async_urls):
+        run_async(
+            pipeline_script_usages(
+                *async_urls,
+                table,
+                model,
+                columns,
+                criteria,
+                values,
+                index_elements,
+                sum_columns,
+                progress,
+                checkpoint.id,
+                batch_size,
+            )
         )
+        # the checkpoint is moved by the session of the pipeline
+        ss.expire(checkpoint)
+        return
+
+    for usages in iter_keyset_pages(
+        ss, model, batch_size, *criteria, columns=columns, after_id=checkpoint.usage_id
+    ):
+        rows = [
+            dict(values, **{k: v for k, v in usage._asdict().items() if k != "id"})
+            for usage in usages
+        ]
+        merge_usages(
+            ms, ss, table, rows, index_elements, sum_columns, progress, checkpoint, usages[-1].id
+        )
+        del rows, usages
+
+
+def merge_usages(
+    ms: Session,
+    ss: Session,
+    table,
+    rows: list,
+    index_elements: tuple,
+    sum_columns: tuple,
+    progress: _TrackThread,
+    checkpoint,
+    usage_id: int,
+) -> None:
+    """
+    Add a page of usages to marzneshin and commit it with the id of its last usage
+    """
+    upsert_usages(ms, table, rows, index_elements, sum_columns, progress)
+    probe = usage_probe(ms, table, rows, index_elements, sum_columns)
+    commit_import_chunk(ms, ss, checkpoint, probe, usage_id=usage_id)
 
-        node_usages = ss.query(script.NodeUsage)
-        for node_usage in node_usages:
-            progress.completed += 1
 
-            exists_node_usage = get_node_usage(
-                created_at=node_usage.created_at, node_id=first_node_id
+def async_engine_url(url: URL) -> Optional[URL]:
+    """
+    Get the url of the database with its async driver, None if the driver is not installed
+    """
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None or find_spec(driver) is None:
+        return None
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}")
+
+
+async def pipeline_script_usages(
+    ms_url: URL,
+    ss_url: URL,
+    table,
+    model,
+    columns: tuple,
+    criteria: tuple,
+    values: dict,
+    index_elements: tuple,
+    sum_columns: tuple,
+    progress: _TrackThread,
+    checkpoint_id: int,
+    batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+    queue_size: int = IMPORT_QUEUE_SIZE,
+) -> None:
+    """
+    Merge the usages of the script database into marzneshin, reading the next pages while a page is written
+    """
+    import script_models as script
+
+    # the pipeline reads only the probes of the pages from marzneshin
+    ms_engine = create_async_engine(ms_url, **database_engine_options(False))
+    set_session_variables(ms_engine.sync_engine, ms_url, True)
+    QUERY_STATS.attach(ms_engine.sync_engine, "marzneshin")
+    ss_engine = create_async_engine(ss_url)
+    QUERY_STATS.attach(ss_engine.sync_engine, "script")
+
+    pages = AsyncQueue(queue_size)
+    try:
+        async with AsyncSession(ms_engine, autoflush=False) as ms, AsyncSession(
+            ss_engine
+        ) as ss, AsyncSession(ss_engine) as reader_session:
+            checkpoint = await ss.get(script.ImportCheckpoint, checkpoint_id)
+            reader = create_task(
+                read_script_usages(
+                    reader_session,
+                    pages,
+                    model,
+                    columns,
+                    criteria,
+                    values,
+                    batch_size,
+                    checkpoint.usage_id,
+                )
             )
-            if exists_node_usage:
-                exists_node_usage.uplink += node_usage.uplink
-                exists_node_usage.downlink += node_usage.downlink
-            else:
-                ms.add(
-                    marzneshin.NodeUsage(
-                        created_at=node_usage.created_at,  # noqa
-                        uplink=node_usage.uplink,  # noqa
-                        downlink=node_usage.downlink,  # noqa
-                        node_id=first_node_id,  # noqa
+            try:
+                while (page := await pages.get()) is not None:
+                    if isinstance(page, Exception):
+                        raise page
+                    rows, usage_id = page
+                    # the pages are committed in order, so the checkpoint works as the synchronous import
+                    await ms.run_sync(
+                        merge_usages,
+                        ss.sync_session,
+                        table,
+                        rows,
+                        index_elements,
+                        sum_columns,
+                        progress,
+                        checkpoint,
+                        usage_id,
                     )
+                    del rows, page
+            finally:
+                reader.cancel()
+    finally:
+        await ms_engine.dispose()
+        await ss_engine.dispose()
+
+
+async def read_script_usages(
+    session: AsyncSession,
+    pages: AsyncQueue,
+    model,
+    columns: tuple,
+    criteria: tuple,
+    values: dict,
+    batch_size: int,
+    after_id: int,
+) -> None:
+    """
+    Put the marzneshin rows of the usage pages and their last ids to the queue, ends it with None or the error
+    """
+    try:
+        while usages := await session.run_sync(
+            get_keyset_page, model, batch_size, *criteria, columns=columns, after_id=after_id
+        ):
+            after_id = usages[-1].id
+            rows = [
+                dict(values, **{k: v for k, v in usage._asdict().items() if k != "id"})
+                for usage in usages
+            ]
+            await pages.put((rows, after_id))
+            del rows, usages
+        await pages.put(None)
+    except Exception as e:  # noqa
+        await pages.put(e)
+
+
+def import_script_user_node_usages(
+    ms: Session,
+    ss: Session,
+    first_node_id: int,
+    progress: _TrackThread,
+    checkpoint,
+    sync: SyncWindow,
+    batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+) -> None:
+    """
+    Merge the node usages of the imported users into the first node of marzneshin
+    """
+    import script_models as script
+
+    import_script_usages(
+        ms,
+        ss,
+        script.NodeUserUsage,
+        (
+            script.NodeUserUsage.id,
+            script.ImportedUser.marzneshin_user_id.label("user_id"),
+            script.NodeUserUsage.created_at,
+            script.NodeUserUsage.used_traffic,
+        ),
+        (
+            script.ImportedUser.target == checkpoint.target,
+            script.ImportedUser.user_id == script.NodeUserUsage.user_id,
+            *sync.usages_criteria(script.NodeUserUsage.created_at),
+        ),
+        dict(node_id=first_node_id),
+        ("created_at", "user_id", "node_id"),
+        ("used_traffic",),
+        progress,
+        checkpoint,
+        batch_size,
+    )
+
+
+def import_script_node_usages(
+    ms: Session,
+    ss: Session,
+    first_node_id: int,
+    progress: _TrackThread,
+    checkpoint,
+    sync: SyncWindow,
+    batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+) -> None:
+    """
+    Merge the node usages into the first node of marzneshin
+    """
+    import script_models as script
+
+    import_script_usages(
+        ms,
+        ss,
+        script.NodeUsage,
+        (
+            script.NodeUsage.id,
+            script.NodeUsage.created_at,
+            script.NodeUsage.uplink,
+            script.NodeUsage.downlink,
+        ),
+        tuple(sync.usages_criteria(script.NodeUsage.created_at)),
+        dict(node_id=first_node_id),
+        ("created_at", "node_id"),
+        ("uplink", "downlink"),
+        progress,
+        checkpoint,
+        batch_size,
+    )
+
+
+def import_script_system(
+    ms: Session, ss: Session, checkpoint, sync: SyncWindow, first_node_id: int
+) -> None:
+    """
+    Add the script database traffic to the marzneshin system traffic and keep the sync state
+    """
+    import marzneshin_models as marzneshin
+    import script_models as script
+
+    QUERY_STATS.start_phase("system")
+    probe = None
+    system = ss.query(script.System).first()
+    marzneshin_system = ms.query(marzneshin.System).first()
+    if marzneshin_system and system:
+        # the marzban system traffic is a total, only its growth since the last import is added
+        uplink = system.uplink - sync.uplink
+        downlink = system.downlink - sync.downlink
+        if uplink or downlink:
+            marzneshin_system.uplink += uplink
+            marzneshin_system.downlink += downlink
+            probe = dict(
+                table="system",
+                id=marzneshin_system.id,
+                columns=["uplink", "downlink"],
+                value=marzneshin_system.uplink + marzneshin_system.downlink,
+            )
+
+    probe = sync.save(ms, ss, checkpoint, system, first_node_id) or probe
+    del system
+
+    commit_import_chunk(ms, ss, checkpoint, probe, stage=script.ImportStage.done.value)
+
+
+def check_foreign_keys(ms: Session) -> bool:
+    """
+    Check the references of the imported rows and return whether they all exist, mysql does not check them while they are written in bulk
+    """
+    import marzneshin_models as marzneshin
+
+    if ms.get_bind().dialect.name not in ("mysql", "mariadb"):
+        return True
+
+    QUERY_STATS.start_phase("foreign keys")
+    valid = True
+    for table in (
+        marzneshin.admins_services,
+        marzneshin.inbounds_services,
+        marzneshin.users_services,
+        marzneshin.User.__table__,
+        marzneshin.NodeUserUsage.__table__,
+        marzneshin.NodeUsage.__table__,
+    ):
+        for foreign_key in table.foreign_keys:
+            column, referred_column = foreign_key.parent, foreign_key.column
+            missing = ms.execute(
+                select(func.count())
+                .select_from(table)
+                .where(
+                    column.isnot(None),
+                    ~select(referred_column).where(referred_column == column).exists(),
                 )
-            ms.flush()
-        del node_usages
+            ).scalar()
+            if missing:
+                error(
+                    f"{missing} rows of {table.name} refer to a missing row of {referred_column.table.name}"
+                )
+                valid = False
+    ms.commit()
+    return valid
 
-        marzneshin_system = ms.query(marzneshin.System).first()
-        if marzneshin_system:
-            system = ss.query(script.System).first()
-            marzneshin_system.uplink += system.uplink
-            marzneshin_system.downlink += system.downlink
-            del system
-        progress.completed += 1
 
-        try:
-            ms.commit()
-        except Exception as e:
-            ms.rollback()
-            raise e
-
-        marzban_jwt_token = ss.query(script.JWT.secret_key).scalar()
-
-        if not exists(JWT_FILE_PATH):
-            if not exists(SCRIPTS_DIR):
-                mkdir(SCRIPTS_DIR)
-            if not exists(CONFIG_DIR):
-                mkdir(CONFIGS_DIR)
-            if not exists(CONFIG_DIR):
-                mkdir(CONFIG_DIR)
-            tokens = set()
-        else:
-            try:
-                with open(JWT_FILE_PATH) as f:
-                    tokens = set(f.read().splitlines())
-            except:  # noqa
-                tokens = set()
+def direct_migrator() -> None:
+    """
+    Migrate data from marzban to marzneshin of the same server without the datastore file
+    """
+    import marzban_models as marzban
 
-        tokens.add(marzban_jwt_token)
-        with open(JWT_FILE_PATH, "w") as f:
-            f.write("\n".join(tokens))
+    clear()
 
-        progress.completed += 1
+    check_marzban_requirements()
+    check_marzneshin_requirements()
 
-        progress.completed = total
-    with open(SOURCE_UPDATER_SYSTEMD_PATH, "w") as f:
-        f.write(SOURCE_UPDATER_SYSTEMD_CONTENT)
+    warning(
+        "The direct migration can not be continued if it is interrupted,"
+        " use the exporter and importer if the panels are large or on different servers"
+    )
+    transform_protocol, non_uuid_handling, rollup = ask_export_options()
+    exists_admins_handling, exists_users_handling = ask_import_options()
 
-    os_system(
-        f"systemctl daemon-reload; systemctl enable {REPO_NAME}; systemctl restart {REPO_NAME}"
+    clear()
+
+    marzban_db_uri, subscription_url_prefix = get_marzban_settings()
+    marzneshin_db_uri = get_marzneshin_db_uri()
+    with Session(create_database_engine(marzban_db_uri)) as session:
+        panel_id = marzban_panel_id(session.query(marzban.JWT.secret_key).scalar() or "")
+    with Session(create_database_engine(marzneshin_db_uri)) as session:
+        incremental = ask_incremental(session, panel_id)
+
+    clear()
+
+    valid = migrate_direct(
+        marzban_db_uri,
+        subscription_url_prefix,
+        transform_protocol,
+        non_uuid_handling,
+        marzneshin_db_uri,
+        exists_admins_handling,
+        exists_users_handling,
+        rollup=rollup,
+        incremental=incremental,
     )
+    enable_source_updater()
+    if rollup:
+        rollup.report()
+    if not valid:
+        error("Some migrated rows refer to missing rows, check the marzneshin database")
+
+    info(f"Peak memory usage: {peak_memory_usage() / 1024 / 1024:.1f} megabytes")
+    save_query_stats()
 
     print("\n\n")
     input("Press Enter to continue...")
 
 
+def migrate_direct(
+    marzban_db_uri: str,
+    subscription_url_prefix: str,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    marzneshin_db_uri: str,
+    exists_admins_handling: str,
+    exists_users_handling: str,
+    batch_size: int = IMPORT_BATCH_SIZE,
+    usages_batch_size: int = IMPORT_USAGES_BATCH_SIZE,
+    save_jwt_token: bool = True,
+    rollup: Optional[UsageRollup] = None,
+    incremental: bool = False,
+) -> bool:
+    """
+    Stream the marzban data to marzneshin, a thread reads marzban while the importer writes the batches
+    """
+    import marzban_models as marzban
+    import marzneshin_models as marzneshin
+    import script_models as script
+
+    QUERY_STATS.reset()
+    marzban_engine = create_database_engine(marzban_db_uri)
+    QUERY_STATS.attach(marzban_engine, "marzban")
+    ms = Session(create_database_engine(marzneshin_db_uri, True), autoflush=False)
+    QUERY_STATS.attach(ms.get_bind(), "marzneshin")
+
+    # the admins and users are staged in memory because the importer reads the
+    # users of each admin together, the usages go to marzneshin as they arrive
+    ss = Session(create_engine("sqlite://"))
+    QUERY_STATS.attach(ss.get_bind(), "script")
+    script.Base.metadata.create_all(ss.get_bind())
+
+    first_node_id, inbounds = get_import_target(ms)
+
+    with Session(marzban_engine) as session:
+        marzban_jwt_token = session.query(marzban.JWT.secret_key).scalar()
+        total = get_total(session, marzban)
+    if not marzban_jwt_token:
+        error("There is no jwt secret key in Marzban", True)
+
+    checkpoint = load_import_checkpoint(
+        ms, ss, md5(marzneshin_db_uri.encode()).hexdigest()
+    )
+    checkpoint.exists_admins_handling = exists_admins_handling
+    checkpoint.exists_users_handling = exists_users_handling
+    checkpoint.incremental = incremental
+    ss.commit()
+
+    batches = Queue(DIRECT_QUEUE_SIZE)
+    stop = Event()
+    producer = Thread(
+        target=produce_marzban_batches,
+        args=(
+            marzban_engine,
+            batches,
+            stop,
+            transform_protocol,
+            non_uuid_handling,
+            subscription_url_prefix,
+            batch_size,
+            usages_batch_size,
+            rollup,
+        ),
+        daemon=True,
+    )
+    producer.start()
+
+    try:
+        with create_progress_bar("Migrating users", total) as progress:
+            imported_user_ids = {}
+            usage_id = 0
+
+            # the end of the batches is marked with an empty table name
+            for table_name, rows in chain(iter_queue(batches), ((None, None),)):
+                if table_name in ("export_info", "admins", "users", "system"):
+                    write_script_rows(ss, ((table_name, rows),))
+                    continue
+                if table_name == "jwt":
+                    continue
+
+                # the users are complete when the first usages arrive
+                if checkpoint.stage == script.ImportStage.users:
+                    create_script_indexes(ss)
+                    sync = SyncWindow(
+                        ms, ss, marzban_panel_id(marzban_jwt_token), incremental
+                    )
+                    import_script_users(
+                        ms,
+                        ss,
+                        inbounds,
+                        exists_admins_handling,
+                        exists_users_handling,
+                        progress,
+                        checkpoint,
+                        sync,
+                        batch_size,
+                    )
+                    checkpoint.stage = script.ImportStage.user_node_usages.value
+                    ss.commit()
+                    imported_user_ids = dict(
+                        ss.query(
+                            script.ImportedUser.user_id,
+                            script.ImportedUser.marzneshin_user_id,
+                        ).filter(script.ImportedUser.target == checkpoint.target)
+                    )
+                if table_name is None:
+                    break
+
+                QUERY_STATS.start_phase("node usages")
+                usage_id += len(rows)
+                rows = sync.new_usages(rows)
+                sync.stage_partial_usages(ss, table_name, rows)
+                if table_name == "node_user_usages":
+                    rows = [
+                        dict(row, node_id=first_node_id, user_id=imported_user_ids[row["user_id"]])
+                        for row in rows
+                        if row["user_id"] in imported_user_ids
+                    ]
+                    index_elements, sum_columns = ("created_at", "user_id", "node_id"), ("used_traffic",)
+                else:
+                    checkpoint.stage = script.ImportStage.node_usages.value
+                    rows = [dict(row, node_id=first_node_id) for row in rows]
+                    index_elements, sum_columns = ("created_at", "node_id"), ("uplink", "downlink")
+                if rows:
+                    merge_usages(
+                        ms,
+                        ss,
+                        marzneshin.Base.metadata.tables[table_name],
+                        rows,
+                        index_elements,
+                        sum_columns,
+                        progress,
+                        checkpoint,
+                        usage_id,
+                    )
+                del rows
+            del imported_user_ids
+
+            import_script_system(ms, ss, checkpoint, sync, first_node_id)
+            valid = check_foreign_keys(ms)
+
+            QUERY_STATS.start_phase("jwt")
+            if save_jwt_token:
+                save_marzban_jwt_token(marzban_jwt_token)
+
+            progress.completed = total
+    finally:
+        stop.set()
+        producer.join()
+        ms.close()
+        ss.close()
+        marzban_engine.dispose()
+    return valid
+
+
+def produce_marzban_batches(
+    engine: Engine,
+    batches: Queue,
+    stop: Event,
+    transform_protocol: str,
+    non_uuid_handling: str,
+    subscription_url_prefix: str,
+    batch_size: int,
+    usages_batch_size: int,
+    rollup: Optional[UsageRollup] = None,
+) -> None:
+    """
+    Put the marzban data batches to the queue, runs in the producer thread of the direct migration
+    """
+    try:
+        with Session(engine, autoflush=False) as ms:
+            for batch in iter_marzban_data(
+                ms,
+                transform_protocol,
+                non_uuid_handling,
+                subscription_url_prefix,
+                SimpleNamespace(completed=0),  # noqa
+                batch_size,
+                usages_batch_size,
+                rollup,
+            ):
+                if not put_until_stopped(batches, batch, stop):
+                    return
+        put_until_stopped(batches, None, stop)
+    except Exception as e:  # noqa
+        put_until_stopped(batches, e, stop)
+
+
+def put_until_stopped(batches: Queue, item, stop: Event) -> bool:
+    """
+    Put the item to the bounded queue, gives up when the consumer stops
+    """
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def iter_queue(batches: Queue) -> Iterator:
+    """
+    Get the items of the queue until the producer ends it, the producer errors are raised here
+    """
+    while (item := batches.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def parse_cli_arguments(arguments: Optional[list] = None) -> Namespace:
+    """
+    Parse the command line arguments of the non-interactive mode
+    """
+    parser = ArgumentParser(
+        prog="migrate.py",
+        description="Migrate from marzban to marzneshin, run without a command for the interactive panel",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    exporter = commands.add_parser("export", help="export data from marzban")
+    exporter.add_argument("-c", "--config", help="yaml file with the options, flags override it")
+    exporter.add_argument("--protocol", choices=CLI_CHOICES["protocol"], help="priority protocol (default: vless)")
+    exporter.add_argument("--non-uuid", choices=CLI_CHOICES["non_uuid"], help="users without uuid (default: revoke)")
+    exporter.add_argument("--workers", type=int, help="export processes (default: 1)")
+    exporter.add_argument("--db-uri", help="marzban database uri (default: read from marzban)")
+    exporter.add_argument("--subscription-url-prefix", help="marzban subscription url prefix")
+    exporter.add_argument("--rollup", choices=CLI_CHOICES["rollup"], help="roll the old usages up to daily or monthly usages")
+    exporter.add_argument(
+        "--rollup-age", type=int, help=f"age in days of the usages to roll up (default: {DEFAULT_ROLLUP_AGE})"
+    )
+    exporter.add_argument("--format", choices=CLI_CHOICES["format"], help="datastore format (default: sqlite)")
+    exporter.add_argument(
+        "-o", "--output", help=f"marzban datastore path (default: {SCRIPT_DB_PATH} or {SCRIPT_ARCHIVE_PATH})"
+    )
+    exporter.add_argument("--batch-size", type=int, help=f"users per batch (default: {EXPORT_BATCH_SIZE})")
+    exporter.add_argument("--usages-batch-size", type=int, help=f"usages per batch (default: {EXPORT_USAGES_BATCH_SIZE})")
+    exporter.add_argument("--stats", help="path to save the query statistics")
+
+    direct = commands.add_parser("direct", help="migrate from marzban to marzneshin of the same server")
+    direct.add_argument("-c", "--config", help="yaml file with the options, flags override it")
+    direct.add_argument("--protocol", choices=CLI_CHOICES["protocol"], help="priority protocol (default: vless)")
+    direct.add_argument("--non-uuid", choices=CLI_CHOICES["non_uuid"], help="users without uuid (default: revoke)")
+    direct.add_argument("--marzban-db-uri", help="marzban database uri (default: read from marzban)")
+    direct.add_argument("--subscription-url-prefix", help="marzban subscription url prefix")
+    direct.add_argument("--rollup", choices=CLI_CHOICES["rollup"], help="roll the old usages up to daily or monthly usages")
+    direct.add_argument(
+        "--rollup-age", type=int, help=f"age in days of the usages to roll up (default: {DEFAULT_ROLLUP_AGE})"
+    )
+    direct.add_argument("--target", choices=CLI_CHOICES["target"], help="marzneshin is new or old (default: new)")
+    direct.add_argument("--admins", choices=CLI_CHOICES["admins"], help="existing admins handling (old target)")
+    direct.add_argument("--users", choices=CLI_CHOICES["users"], help="existing users handling (old target)")
+    direct.add_argument("--db-uri", help="marzneshin database uri (default: read from marzneshin)")
+    direct.add_argument("--batch-size", type=int, help=f"users per batch (default: {IMPORT_BATCH_SIZE})")
+    direct.add_argument("--usages-batch-size", type=int, help=f"usages per batch (default: {IMPORT_USAGES_BATCH_SIZE})")
+    direct.add_argument("--stats", help="path to save the query statistics")
+    direct.add_argument(
+        "--incremental",
+        action="store_true",
+        default=None,
+        help="migrate only the changes since the last migration of this marzban",
+    )
+    direct.add_argument(
+        "--no-source-updater",
+        action="store_false",
+        dest="source_updater",
+        default=None,
+        help="do not save the jwt token and do not install the subscription source updater",
+    )
+
+    importer = commands.add_parser("import", help="import data to marzneshin")
+    importer.add_argument("-c", "--config", help="yaml file with the options, flags override it")
+    importer.add_argument(
+        "-i", "--input", help=f"sqlite or compressed marzban datastore path (default: {SCRIPT_DB_PATH})"
+    )
+    importer.add_argument("--target", choices=CLI_CHOICES["target"], help="marzneshin is new or old (default: new)")
+    importer.add_argument("--admins", choices=CLI_CHOICES["admins"], help="existing admins handling (old target)")
+    importer.add_argument("--users", choices=CLI_CHOICES["users"], help="existing users handling (old target)")
+    importer.add_argument("--db-uri", help="marzneshin database uri (default: read from marzneshin)")
+    importer.add_argument("--batch-size", type=int, help=f"users per batch (default: {IMPORT_BATCH_SIZE})")
+    importer.add_argument("--usages-batch-size", type=int, help=f"usages per batch (default: {IMPORT_USAGES_BATCH_SIZE})")
+    importer.add_argument("--stats", help="path to save the query statistics")
+    importer.add_argument("--reimport", action="store_true", default=None, help="import an already imported datastore again")
+    importer.add_argument(
+        "--incremental",
+        action="store_true",
+        default=None,
+        help="import only the changes since the last import of this marzban",
+    )
+    importer.add_argument(
+        "--no-source-updater",
+        action="store_false",
+        dest="source_updater",
+        default=None,
+        help="do not save the jwt token and do not install the subscription source updater",
+    )
+
+    return parser.parse_args(arguments)
+
+
+def load_cli_options(arguments: Namespace) -> Namespace:
+    """
+    Merge the defaults, the config file and the flags of a command
+    """
+    options = dict(CLI_DEFAULTS[arguments.command])
+
+    if arguments.config:
+        try:
+            with open(arguments.config, encoding="utf-8") as file:
+                config = safe_load(file) or {}
+        except (OSError, ValueError) as e:
+            raise ValueError(f"can not read {arguments.config}: {e}")
+        if not isinstance(config, dict):
+            raise ValueError(f"{arguments.config} must be a mapping")
+
+        # the config may keep the options of both commands in their own sections
+        sections = {key: config.pop(key) for key in tuple(CLI_DEFAULTS) if key in config}
+        config.update(sections.get(arguments.command) or {})
+        for key, value in config.items():
+            key = key.replace("-", "_")
+            if key not in options:
+                raise ValueError(f"unknown {arguments.command} option {key} in {arguments.config}")
+            options[key] = value
+
+    for key, value in vars(arguments).items():
+        if key in options and value is not None:
+            options[key] = value
+
+    for key, allowed in CLI_CHOICES.items():
+        if options.get(key) is not None and options[key] not in allowed:
+            raise ValueError(f"{key} must be one of {', '.join(allowed)}")
+    for key in ("workers", "batch_size", "usages_batch_size"):
+        if key in options and (not isinstance(options[key], int) or options[key] < 1):
+            raise ValueError(f"{key} must be a positive number")
+    if "rollup_age" in options and (
+        not isinstance(options["rollup_age"], int) or options["rollup_age"] < 0
+    ):
+        raise ValueError("rollup_age must be a number of days")
+    if options.get("format") == "compressed" and options["workers"] > 1:
+        raise ValueError("the compressed datastore is exported by one worker")
+    if options.get("target") == "old" and not (options["admins"] and options["users"]):
+        raise ValueError("admins and users handling are required for an old marzneshin")
+
+    return Namespace(**options)
+
+
+def cli_marzban_settings(db_uri: Optional[str], subscription_url_prefix: Optional[str]) -> tuple:
+    """
+    Get the marzban database uri and subscription url prefix, the given ones are preferred
+    """
+    if db_uri:
+        return db_uri, subscription_url_prefix or MARZBAN_DEFAULT_SUBSCRIPTION_URL_PREFIX
+
+    check_marzban_requirements()
+    marzban_db_uri, marzban_subscription_url_prefix = get_marzban_settings()
+    if subscription_url_prefix is None:
+        subscription_url_prefix = marzban_subscription_url_prefix
+    return marzban_db_uri, subscription_url_prefix
+
+
+def cli_rollup(options: Namespace) -> Optional[UsageRollup]:
+    """
+    Get the usages rollup of the options, if it is enabled
+    """
+    if not options.rollup:
+        return None
+    return UsageRollup(options.rollup, options.rollup_age)
+
+
+def cli_export(options: Namespace) -> int:
+    """
+    Export data from marzban without asking anything
+    """
+    db_uri, subscription_url_prefix = cli_marzban_settings(
+        options.db_uri, options.subscription_url_prefix
+    )
+
+    rollup = cli_rollup(options)
+    export_marzban(
+        db_uri,
+        subscription_url_prefix,
+        options.protocol,
+        options.non_uuid,
+        options.workers,
+        options.output or (SCRIPT_ARCHIVE_PATH if options.format == "compressed" else SCRIPT_DB_PATH),
+        options.batch_size,
+        options.usages_batch_size,
+        options.format,
+        rollup,
+    )
+    if rollup:
+        rollup.report()
+
+    info(f"Peak memory usage: {peak_memory_usage() / 1024 / 1024:.1f} megabytes")
+    save_query_stats(options.stats, False)
+    return EXIT_SUCCESS
+
+
+def cli_import(options: Namespace) -> int:
+    """
+    Import data to marzneshin without asking anything
+    """
+    import script_models as script
+
+    input_path = options.input or default_datastore_path()
+    if not check_datastore_file(input_path):
+        error(f"{input_path} is not a marzban datastore")
+        return EXIT_USAGE
+    try:
+        db_path = open_datastore(input_path)
+    except ValueError as e:
+        error(str(e))
+        return EXIT_FAILURE
+
+    if options.db_uri:
+        db_uri = options.db_uri
+    else:
+        check_marzneshin_requirements()
+        db_uri = get_marzneshin_db_uri()
+    ms, ss, first_node_id, inbounds = open_import_sessions(db_uri, db_path)
+
+    checkpoint = load_import_checkpoint(ms, ss, md5(db_uri.encode()).hexdigest())
+    if checkpoint.stage == script.ImportStage.done:
+        if not options.reimport:
+            warning("This datastore is already imported to this Marzneshin, use --reimport to import it again")
+            return EXIT_SUCCESS
+        reset_import_checkpoint(ss, checkpoint)
+
+    if checkpoint.admin_id or checkpoint.stage != script.ImportStage.users:
+        info("The previous import is not finished, it will be continued from the last checkpoint")
+        exists_admins_handling = checkpoint.exists_admins_handling
+        exists_users_handling = checkpoint.exists_users_handling
+    else:
+        if options.target == "old":
+            exists_admins_handling = options.admins
+            exists_users_handling = options.users
+        else:
+            exists_admins_handling = "skip"
+            exists_users_handling = "skip"
+        checkpoint.exists_admins_handling = exists_admins_handling
+        checkpoint.exists_users_handling = exists_users_handling
+        checkpoint.incremental = options.incremental
+        ss.commit()
+
+    valid = import_marzneshin(
+        ms,
+        ss,
+        first_node_id,
+        inbounds,
+        exists_admins_handling,
+        exists_users_handling,
+        checkpoint,
+        options.batch_size,
+        options.usages_batch_size,
+        options.source_updater,
+    )
+    if options.source_updater:
+        enable_source_updater()
+
+    info(f"Peak memory usage: {peak_memory_usage() / 1024 / 1024:.1f} megabytes")
+    save_query_stats(options.stats, False)
+    return EXIT_SUCCESS if valid else EXIT_FAILURE
+
+
+def cli_direct(options: Namespace) -> int:
+    """
+    Migrate from marzban to marzneshin without the datastore file and without asking anything
+    """
+    marzban_db_uri, subscription_url_prefix = cli_marzban_settings(
+        options.marzban_db_uri, options.subscription_url_prefix
+    )
+    if options.db_uri:
+        db_uri = options.db_uri
+    else:
+        check_marzneshin_requirements()
+        db_uri = get_marzneshin_db_uri()
+
+    if options.target == "old":
+        exists_admins_handling = options.admins
+        exists_users_handling = options.users
+    else:
+        exists_admins_handling = "skip"
+        exists_users_handling = "skip"
+
+    rollup = cli_rollup(options)
+    valid = migrate_direct(
+        marzban_db_uri,
+        subscription_url_prefix,
+        options.protocol,
+        options.non_uuid,
+        db_uri,
+        exists_admins_handling,
+        exists_users_handling,
+        options.batch_size,
+        options.usages_batch_size,
+        options.source_updater,
+        rollup,
+        options.incremental,
+    )
+    if options.source_updater:
+        enable_source_updater()
+    if rollup:
+        rollup.report()
+
+    info(f"Peak memory usage: {peak_memory_usage() / 1024 / 1024:.1f} megabytes")
+    save_query_stats(options.stats, False)
+    return EXIT_SUCCESS if valid else EXIT_FAILURE
+
+
+def main(arguments: Optional[list] = None) -> int:
+    """
+    Run a command of the non-interactive mode and return its exit code
+    """
+    arguments = parse_cli_arguments(arguments)
+    try:
+        options = load_cli_options(arguments)
+    except ValueError as e:
+        error(str(e))
+        return EXIT_USAGE
+
+    try:
+        if arguments.command == "export":
+            return cli_export(options)
+        if arguments.command == "direct":
+            return cli_direct(options)
+        return cli_import(options)
+    except KeyboardInterrupt:
+        error("Interrupted")
+        return EXIT_INTERRUPTED
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else EXIT_FAILURE
+    except Exception:  # noqa
+        CONSOLE.print_exception()
+        return EXIT_FAILURE
+
+
 if __name__ == "__main__":
+    if len(argv) > 1:
+        sys_exit(main())
     panel()
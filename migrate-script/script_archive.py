@@ -0,0 +1,200 @@
+"""
+Compressed datastore of the migrate script, the script database tables as a stream of column batches
+"""
+
+from array import array
+from datetime import datetime, timedelta
+from enum import Enum
+from json import dumps, loads
+from os import replace
+from struct import Struct
+from sys import byteorder
+from typing import Iterable, Iterator
+from zlib import compress, decompress, error as ZlibError
+
+MAGIC = b"M2MDS1\n"
+COMPRESSION_LEVEL = 6
+
+# every frame is a json header and a zlib compressed payload of its columns
+FRAME_SIZES = Struct("<II")  # header size, payload size
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NULL_INDEX = 0xFFFFFFFF
+
+
+def is_script_archive(path: str) -> bool:
+    """
+    Check if the file is a compressed datastore
+    """
+    try:
+        with open(path, "rb") as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_script_archive(
+    path: str, batches: Iterable[tuple], level: int = COMPRESSION_LEVEL
+) -> dict:
+    """
+    Write the (script table name, rows) batches to a compressed datastore and return the rows count of the tables
+    """
+    counts = {}
+    # the datastore is written next to the path and moved at the end, so a
+    # broken export never leaves a datastore that looks complete
+    with open(f"{path}.part", "wb") as file:
+        file.write(MAGIC)
+        for table_name, rows in batches:
+            if not rows:
+                continue
+            columns = []
+            blobs = []
+            for name in rows[0]:
+                encoding, blob = encode_column([row[name] for row in rows])
+                columns.append((name, encoding, len(blob)))
+                blobs.append(blob)
+            write_frame(
+                file,
+                dict(table=table_name, rows=len(rows), columns=columns),
+                compress(b"".join(blobs), level),
+            )
+            counts[table_name] = counts.get(table_name, 0) + len(rows)
+            del rows, blobs
+        write_frame(file, dict(end=True, counts=counts), b"")
+    replace(f"{path}.part", path)
+
+    return counts
+
+
+def iter_script_archive(path: str) -> Iterator[tuple]:
+    """
+    Read the (script table name, rows) batches of a compressed datastore
+    """
+    counts = {}
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a compressed datastore")
+        while True:
+            sizes = file.read(FRAME_SIZES.size)
+            if len(sizes) != FRAME_SIZES.size:
+                raise ValueError(f"{path} is truncated")
+            header_size, payload_size = FRAME_SIZES.unpack(sizes)
+            header = loads(file.read(header_size))
+            payload = file.read(payload_size)
+            if len(payload) != payload_size:
+                raise ValueError(f"{path} is truncated")
+
+            if header.get("end"):
+                if header["counts"] != counts:
+                    raise ValueError(f"{path} is corrupted")
+                return
+
+            try:
+                payload = decompress(payload)
+            except ZlibError:
+                raise ValueError(f"{path} is corrupted")
+            values = {}
+            offset = 0
+            for name, encoding, size in header["columns"]:
+                values[name] = decode_column(encoding, payload[offset:offset + size])
+                offset += size
+            del payload
+
+            yield header["table"], [
+                dict(zip(values, row)) for row in zip(*values.values())
+            ]
+            counts[header["table"]] = counts.get(header["table"], 0) + header["rows"]
+
+
+def write_frame(file, header: dict, payload: bytes) -> None:
+    header = dumps(header, separators=(",", ":")).encode()
+    file.write(FRAME_SIZES.pack(len(header), len(payload)))
+    file.write(header)
+    file.write(payload)
+
+
+def encode_column(values: list) -> tuple:
+    """
+    Encode the values of a column, integers are delta encoded and datetimes are dictionary encoded
+    """
+    if all(type(value) is int for value in values):
+        try:
+            return "int", int_array_bytes(delta_encode(values))
+        except OverflowError:  # out of the 64-bit range, saved as json
+            pass
+
+    if all(value is None or isinstance(value, datetime) for value in values):
+        # the datetimes are saved as the wall time, as the sqlite datastore does
+        times = [
+            None if value is None else (value.replace(tzinfo=None) - EPOCH) // MICROSECOND
+            for value in values
+        ]
+        dictionary = sorted({time for time in times if time is not None})
+        positions = {time: index for index, time in enumerate(dictionary)}
+        indexes = array("I", (NULL_INDEX if time is None else positions[time] for time in times))
+        dictionary = int_array_bytes(delta_encode(dictionary))
+        return "time", len(dictionary).to_bytes(4, "little") + dictionary + array_bytes(indexes)
+
+    return "json", dumps(
+        [value.name if isinstance(value, Enum) else value for value in values],
+        separators=(",", ":"),
+    ).encode()
+
+
+def decode_column(encoding: str, blob: bytes) -> list:
+    """
+    Decode the values of a column
+    """
+    if encoding == "int":
+        return delta_decode(bytes_array("q", blob))
+
+    if encoding == "time":
+        dictionary_size = int.from_bytes(blob[:4], "little")
+        dictionary = [
+            EPOCH + time * MICROSECOND
+            for time in delta_decode(bytes_array("q", blob[4:4 + dictionary_size]))
+        ]
+        indexes = bytes_array("I", blob[4 + dictionary_size:])
+        return [None if index == NULL_INDEX else dictionary[index] for index in indexes]
+
+    if encoding == "json":
+        return loads(blob)
+
+    raise ValueError(f"unknown column encoding {encoding}")
+
+
+def delta_encode(values: list) -> list:
+    previous = 0
+    deltas = []
+    for value in values:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+def delta_decode(deltas: Iterable[int]) -> list:
+    value = 0
+    values = []
+    for delta in deltas:
+        value += delta
+        values.append(value)
+    return values
+
+
+def int_array_bytes(values: list) -> bytes:
+    return array_bytes(array("q", values))
+
+
+def array_bytes(values: array) -> bytes:
+    if byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def bytes_array(typecode: str, blob: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(blob)
+    if byteorder == "big":
+        values.byteswap()
+    return values
@@ -1,6 +1,6 @@
 from secrets import token_hex
 
-from sqlalchemy import Integer, Column, String, text, DateTime, Boolean, BigInteger, Enum, ForeignKey
+from sqlalchemy import Integer, Column, String, text, DateTime, Boolean, BigInteger, Enum, ForeignKey, JSON
 from sqlalchemy.orm import declarative_base, relationship
 from enum import Enum as EnumSubClass
 Base = declarative_base()
@@ -21,6 +21,13 @@ class ReminderType(str, EnumSubClass):
     expiration_date = "expiration_date"
     data_usage = "data_usage"
 
+class ImportStage(str, EnumSubClass):
+    users = "users"
+    user_node_usages = "user_node_usages"
+    node_usages = "node_usages"
+    system = "system"
+    done = "done"
+
 
 class Admin(Base):
     __tablename__ = "admins"
@@ -106,3 +113,34 @@ class JWT(Base):
     secret_key = Column(
         String(64)
     )
+
+
+class ExportInfo(Base):
+    __tablename__ = "export_info"
+
+    id = Column(Integer, primary_key=True)
+    exported_at = Column(DateTime)  # marzban time of the export start
+    rolled_up_before = Column(DateTime)  # the usages before it are rolled up
+
+
+class ImportCheckpoint(Base):
+    __tablename__ = "import_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    target = Column(String, unique=True)  # hash of the marzneshin database uri
+    stage = Column(String, default=ImportStage.users.value)
+    exists_admins_handling = Column(String)
+    exists_users_handling = Column(String)
+    admin_id = Column(Integer, default=0)  # the admin that its users are importing
+    marzneshin_admin_id = Column(Integer)
+    user_id = Column(Integer, default=0)  # the last imported user of the admin
+    usage_id = Column(Integer, default=0)  # the last imported usage of the stage
+    pending = Column(JSON)  # the checkpoint of the chunk that is committing
+    incremental = Column(Boolean, default=False)  # only the changes since the last import are imported
+
+class ImportedUser(Base):
+    __tablename__ = "imported_users"
+
+    target = Column(String, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    marzneshin_user_id = Column(Integer)